@@ -0,0 +1,104 @@
+# Build the worldmap of a recorded run on several processes
+# Every frame is mapped independently, so the frames are split in shards that
+# are mapped into private maps by a pool of workers and added up at the end
+# Example: $ python batch_map.py ../test_dataset/robot_log.csv --workers 4 --out map.png
+import argparse
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+
+from perception import threshold_frame, map_frame, BatchMapper
+from replay import frames, frame_count
+from supporting_functions import convert_to_float, render_map
+from rover_state import RoverState
+from worldmap import OccupancyGrid
+
+# Map the frames from first to last into a private worldmap and return its counters
+# with a batch size the frames are mapped that many at a time by a BatchMapper
+def map_shard(log_path, first, last, world_size, batch=0):
+    worldmap = OccupancyGrid(world_size)
+    if batch > 0:
+        mapper = BatchMapper(chunk=batch)
+        source = frames(log_path, first, last)
+        while True:
+            chunk = list(itertools.islice(source, batch))
+            if not chunk:
+                return worldmap.data
+            poses = [[convert_to_float(row[name]) for name in ('X_Position', 'Y_Position', 'Yaw', 'Pitch', 'Roll')]
+                     for row, _ in chunk]
+            mapper.map(worldmap, np.stack([image for _, image in chunk]), poses)
+    for row, image in frames(log_path, first, last):
+        pos = (convert_to_float(row['X_Position']), convert_to_float(row['Y_Position']))
+        _, threshold_img, threshhold_rock, threshhold_obs, _ = threshold_frame(
+            image, convert_to_float(row['Pitch']))
+        map_frame(worldmap, threshold_img, threshhold_rock, threshhold_obs, pos,
+                  convert_to_float(row['Yaw']), convert_to_float(row['Roll']))
+    return worldmap.data
+
+# Map every frame of a run with the given number of worker processes
+# returns a Rover holding the merged worldmap and its map statistics
+# the run is a robot_log.csv or a packed run log, whose shards are read without scanning the run
+def batch_map(log_path, workers=None, world_size=200, shards_per_worker=4, batch=0):
+    workers = workers or os.cpu_count() or 1
+    count = frame_count(log_path)
+    Rover = RoverState()
+    Rover.worldmap = OccupancyGrid(world_size)
+    # a few shards per worker keeps them all busy until the end
+    shard_count = max(1, min(count, workers * shards_per_worker))
+    bounds = np.linspace(0, count, shard_count + 1).astype(int)
+    start = time.perf_counter()
+    if workers == 1:
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            Rover.worldmap.merge(map_shard(log_path, first, last, world_size, batch))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for partial in pool.map(map_shard, [log_path] * shard_count, bounds[:-1], bounds[1:],
+                                    [world_size] * shard_count, [batch] * shard_count):
+                Rover.worldmap.merge(partial)
+    Rover.total_time = time.perf_counter() - start
+    Rover.map_stats.scan(Rover.worldmap, Rover.samples_pos)
+    return Rover, count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Map a recorded run on several processes')
+    parser.add_argument(
+        'log',
+        type=str,
+        nargs='?',
+        default='../test_dataset/robot_log.csv',
+        help='Path to the robot_log.csv of the run or to its packed run log.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Number of worker processes, defaults to the number of cores.'
+    )
+    parser.add_argument(
+        '--world-size',
+        type=int,
+        default=200,
+        help='Size in meters of the square worldmap.'
+    )
+    parser.add_argument(
+        '--batch',
+        type=int,
+        default=0,
+        help='Map this many frames at a time with the batched kernel (the ground region path, see --roi of replay.py), 0 maps them one by one.'
+    )
+    parser.add_argument(
+        '--out',
+        type=str,
+        default='',
+        help='Path to save the rendered worldmap image to.'
+    )
+    args = parser.parse_args()
+
+    Rover, count = batch_map(args.log, args.workers, args.world_size, batch=args.batch)
+    print('{} frames in {:.2f} s ({:.1f} FPS)'.format(count, Rover.total_time, count / Rover.total_time))
+    print('Mapped: {}%  Fidelity: {}%'.format(Rover.map_stats.perc_mapped(), Rover.map_stats.fidelity()))
+    if args.out != '':
+        cv2.imwrite(args.out, cv2.cvtColor(render_map(Rover), cv2.COLOR_RGB2BGR))
@@ -0,0 +1,156 @@
+# Benchmarks of the perception and supporting_functions hot paths on the
+# frames of test_dataset. Results can be saved as a baseline and later runs
+# fail when a function got slower than the baseline by more than a threshold
+# Example: $ python benchmark.py --save            (record the baseline)
+#          $ python benchmark.py --threshold 0.2   (fail if 20% slower)
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import numpy as np
+
+import perception
+from perception import (perspect_transform, color_thresh, thresh_rock, obs_thresh,
+                        rover_coords, pix_to_world, x_y_to_img, perception_step)
+from replay import read_log, resolve_image, load_image, apply_row
+from supporting_functions import create_output_images, convert_to_float
+from rover_state import RoverState
+from worldmap import OccupancyGrid
+
+# Time fn over every input, repeated rounds times
+# returns min/mean/median/max in microseconds per call, the rounds are averaged over the inputs
+def measure(fn, inputs, rounds):
+    fn(inputs[0]) # warm up caches and lazily built tables
+    per_call = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for item in inputs:
+            fn(item)
+        per_call.append((time.perf_counter() - start) / len(inputs) * 1e6)
+    per_call = np.array(per_call)
+    return {'min_us': float(per_call.min()), 'mean_us': float(per_call.mean()),
+            'median_us': float(np.median(per_call)), 'max_us': float(per_call.max())}
+
+# Load count frames of the run with a Rover set up for each of them
+def load_frames(csv_path, count):
+    rows = list(read_log(csv_path))
+    rows = rows[::max(1, len(rows) // count)][:count]
+    return [(row, load_image(resolve_image(csv_path, row['Path']))) for row in rows]
+
+def run_benchmarks(csv_path, count=20, rounds=5):
+    frames = load_frames(csv_path, count)
+    images = [image for _, image in frames]
+    warped = [perception.WARP.warp(image).copy() for image in images]
+    navigable = [color_thresh(img, perception.NAV_THRESH) for img in warped]
+    coords = [rover_coords(binary) for binary in navigable]
+    Rover = RoverState()
+    rows = [row for row, _ in frames]
+    mapper = perception.BatchMapper()
+    poses = [[convert_to_float(row[name]) for name in ('X_Position', 'Y_Position', 'Yaw', 'Pitch', 'Roll')]
+             for row in rows]
+    start = time.time()
+
+    def step(item):
+        row, image = item
+        apply_row(Rover, row, image, start)
+        perception_step(Rover)
+        Rover.prev_angles = Rover.nav_angles
+
+    cases = {
+        'perspect_transform': (lambda img: perspect_transform(img, perception.src, perception.dest), images),
+        'WarpEngine.warp': (perception.WARP.warp, images),
+        'GroundROI.threshold_frame': (lambda img: perception.ROI.threshold_frame(img, 0.0), images),
+        'color_thresh': (lambda img: color_thresh(img, perception.NAV_THRESH), warped),
+        'thresh_rock': (thresh_rock, warped),
+        'obs_thresh': (lambda img: obs_thresh(img, perception.NAV_THRESH), warped),
+        'rover_coords': (rover_coords, navigable),
+        'pix_to_world': (lambda xy: pix_to_world(xy[0], xy[1], 100.0, 85.0, 56.8, 200, 10), coords),
+        'x_y_to_img': (lambda xy: x_y_to_img(xy[0], xy[1], Rover), coords),
+        'perception_step': (step, frames),
+        # a single call mapping all of the frames
+        'BatchMapper.map': (lambda batch: mapper.map(OccupancyGrid(200), batch[0], batch[1]),
+                            [(np.stack(images), poses)]),
+        'create_output_images': (lambda _: create_output_images(Rover), rows),
+    }
+    results = {}
+    # perception_step and decision_step report on stdout, keep it out of the way
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for name, (fn, inputs) in cases.items():
+            results[name] = measure(fn, inputs, rounds)
+    return results
+
+# Names of the benchmarks whose median is more than threshold slower than the baseline
+def regressions(results, baseline, threshold):
+    slower = []
+    for name, stats in results.items():
+        if name in baseline and stats['median_us'] > baseline[name]['median_us'] * (1 + threshold):
+            slower.append(name)
+    return slower
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the perception hot paths')
+    parser.add_argument(
+        '--log',
+        type=str,
+        default='../test_dataset/robot_log.csv',
+        help='Path to the robot_log.csv of the frames to benchmark with.'
+    )
+    parser.add_argument(
+        '--frames',
+        type=int,
+        default=20,
+        help='Number of frames of the run to use.'
+    )
+    parser.add_argument(
+        '--rounds',
+        type=int,
+        default=5,
+        help='Number of times every benchmark goes over the frames.'
+    )
+    parser.add_argument(
+        '--baseline',
+        type=str,
+        default='benchmark_baseline.json',
+        help='Baseline file to compare against (or to write with --save).'
+    )
+    parser.add_argument(
+        '--save',
+        action='store_true',
+        help='Save the results as the new baseline instead of comparing.'
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.25,
+        help='Allowed slowdown of the median over the baseline, 0.25 is 25%%.'
+    )
+    args = parser.parse_args()
+
+    baseline = {}
+    if not args.save:
+        # without a baseline nothing would be compared and every run would pass
+        if not os.path.exists(args.baseline):
+            print('Baseline {} not found, record one with --save'.format(args.baseline))
+            sys.exit(2)
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    results = run_benchmarks(args.log, args.frames, args.rounds)
+    print('{:<26} {:>11} {:>11} {:>11}'.format('benchmark', 'min us', 'median us', 'baseline'))
+    for name, stats in results.items():
+        base = '{:11.1f}'.format(baseline[name]['median_us']) if name in baseline else '{:>11}'.format('-')
+        print('{:<26} {:11.1f} {:11.1f} {}'.format(name, stats['min_us'], stats['median_us'], base))
+
+    if args.save:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print('Saved baseline to {}'.format(args.baseline))
+    else:
+        missing = [name for name in results if name not in baseline]
+        if missing:
+            print('Not in the baseline, not compared: {}'.format(', '.join(missing)))
+        slower = regressions(results, baseline, args.threshold)
+        if slower:
+            print('Slower than the baseline by more than {:.0%}: {}'.format(args.threshold, ', '.join(slower)))
+            sys.exit(1)
@@ -31,7 +31,7 @@ def decision_step(Rover):
         Rover.brake = 0
         Rover.steer = -15
         # stop turning when the rover is close enough to a wall
-        if len(Rover.nav_angles) < 1800:
+        if len(Rover.nav_angles) < Rover.rotate_forward:
             Rover.steer = 0
             Rover.mode = "go"
     # The Rover is now pointing straight at a wall
@@ -1,8 +1,8 @@
 # Do the necessary imports
 import argparse
+import atexit
 import shutil
 import base64
-from datetime import datetime
 import os
 import cv2
 import numpy as np
@@ -13,81 +13,26 @@ from PIL import Image
 from flask import Flask
 from io import BytesIO, StringIO
 import json
+import logging
 import pickle
-import matplotlib.image as mpimg
 import time
 
 # Import functions for perception and decision making
+import perception
 from perception import perception_step
 from decision import decision_step
-from supporting_functions import update_rover, create_output_images
+from supporting_functions import update_rover, create_output_images, InsetEncoder
+from worldmap import OccupancyGrid, TiledOccupancyGrid
+from rover_state import RoverState
+from pipeline import LatestFrameWorker
+from scheduler import PerceptionScheduler
+from recorder import RunRecorder
+import profiler
 # Initialize socketio server and Flask application 
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
 app = Flask(__name__)
 
-# Read in ground truth map and create 3-channel green version for overplotting
-# NOTE: images are read in by default with the origin (0, 0) in the upper left
-# and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying 
-# map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
-
-# Define RoverState() class to retain rover state parameters
-class RoverState():
-    def __init__(self):
-        self.start_time = None # To record the start time of navigation
-        self.total_time = None # To record total duration of naviagation
-        self.img = None # Current camera image
-        self.pos = None # Current position (x, y)
-        self.yaw = None # Current yaw angle
-        self.pitch = None # Current pitch angle
-        self.roll = None # Current roll angle
-        self.vel = None # Current velocity
-        self.steer = 0 # Current steering angle
-        self.throttle = 0 # Current throttle value
-        self.brake = 0 # Current brake value
-        self.nav_angles = None # Angles of navigable terrain pixels
-        self.nav_dists = None # Distances of navigable terrain pixels
-        self.ground_truth = ground_truth_3d # Ground truth worldmap
-        self.mode = 'go-rotate'
-        self.throttle_set = 0.1 # Throttle setting when accelerating
-        self.brake_set = 10 # Brake setting when braking
-        # The stop_forward and go_forward fields below represent total count
-        # of navigable terrain pixels.  This is a very crude form of knowing
-        # when you can keep going and when you should stop.  Feel free to
-        # get creative in adding new fields or modifying these!
-        self.stop_forward = 100 # Threshold to initiate stopping
-        self.go_forward = 500 # Threshold to go forward again
-        self.max_vel = 2 # Maximum velocity (meters/second)
-        # Image output from perception step
-        # Update this image to display your intermediate analysis steps
-        # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float) 
-        # Worldmap
-        # Update this image with the positions of navigable terrain
-        # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float) 
-        self.samples_pos = None # To store the actual sample positions
-        self.samples_to_find = 0 # To store the initial count of samples
-        self.samples_located = 0 # To store number of samples located on map
-        self.samples_collected = 0 # To count the number of samples collected
-        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
-        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
-        self.send_pickup = False # Set to True to trigger rock pickup
-        #STUDENT EDIT
-        #variable for mainting rover angles from previous iteration
-        self.prev_angles = None
-        self.rock_dists = None
-        self.rock_angles = None
-        self.rock_found = False
-        self.prev_mode = None
-        self.first_stuck = None
-        self.rock_lost = False
-        self.first_rock = 0
-
 # Initialize our rover 
 Rover = RoverState()
 
@@ -97,6 +42,14 @@ frame_counter = 0
 # Initalize second counter
 second_counter = time.time()
 fps = None
+# Worker running perception and decision off the socket handler, see --pipelined
+pipeline = None
+# Background encoder of the inset images, see --inset-rate
+inset_encoder = None
+# Adaptive rate of perception, see --adaptive
+scheduler = None
+# Writer of the recorded run when an image folder is given
+recorder = None
 
 
 # Define telemetry function for what to do with incoming data
@@ -110,54 +63,80 @@ def telemetry(sid, data):
         fps = frame_counter
         frame_counter = 0
         second_counter = time.time()
-    print("Current FPS: {}".format(fps))
+        print("Current FPS: {}".format(fps))
+        profiler.maybe_dump()
 
     if data:
-        global Rover
+        # If you want to save camera images from autonomous driving specify a path
+        # Example: $ python drive_rover.py image_folder_path
+        # every frame is queued as it came in, also the ones the pipelined worker drops
+        if recorder is not None:
+            recorder.record(data, Rover.brake)
+        if pipeline is not None:
+            # hand the frame to the worker and answer right away with the
+            # freshest decision, a pickup is only ever sent once
+            pipeline.submit(data)
+            response, fresh = pipeline.latest()
+            if response is not None and response[0] and not fresh:
+                response = (False,) + response[1:]
+            send_response(response)
+        else:
+            send_response(drive(data))
+
+    else:
+        sio.emit('manual', data={}, skip_sid=True)
+
+# Run a telemetry frame through perception and decision
+# returns (send pickup, commands, inset image 1, inset image 2)
+# or None for invalid telemetry
+def drive(data):
+    global Rover
+    with profiler.stage('frame'):
         # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
+        Rover, _ = update_rover(Rover, data)
+        response = None
 
         if np.isfinite(Rover.vel):
 
             # Execute the perception and decision steps to update the Rover's state
-            Rover = perception_step(Rover)
+            with profiler.stage('perception'):
+                if scheduler is None:
+                    Rover = perception_step(Rover)
+                else:
+                    Rover = scheduler.step(Rover)
             Rover.prev_angles = Rover.nav_angles
-            Rover = decision_step(Rover)
+            with profiler.stage('decision'):
+                Rover = decision_step(Rover)
 
             # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
-
-            # The action step!  Send commands to the rover!
-            # Don't send both of these, they both trigger the simulator
-            # to send back new telemetry so we must only send one
-            # back in respose to the current telemetry data.
+            with profiler.stage('output'):
+                out_image_string1, out_image_string2 = create_output_images(Rover, inset_encoder)
 
             # If in a state where want to pickup a rock send pickup command
-            if Rover.send_pickup and not Rover.picking_up:
-                send_pickup()
+            pickup = Rover.send_pickup and not Rover.picking_up
+            if pickup:
                 # Reset Rover flags
                 Rover.send_pickup = False
-            else:
-                # Send commands to the rover!
-                commands = (Rover.throttle, Rover.brake, Rover.steer)
-                send_control(commands, out_image_string1, out_image_string2)
+            commands = (Rover.throttle, Rover.brake, Rover.steer)
+            response = (pickup, commands, out_image_string1, out_image_string2)
 
-        # In case of invalid telemetry, send null commands
-        else:
+        return response
 
+# The action step!  Send commands to the rover!
+# Don't send both of these, they both trigger the simulator
+# to send back new telemetry so we must only send one
+# back in respose to the current telemetry data.
+def send_response(response):
+    with profiler.stage('emit'):
+        # In case of invalid telemetry (or no decision yet), send null commands
+        if response is None:
             # Send zeros for throttle, brake and steer and empty images
             send_control((0, 0, 0), '', '')
-
-        # If you want to save camera images from autonomous driving specify a path
-        # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
-
-    else:
-        sio.emit('manual', data={}, skip_sid=True)
+        elif response[0]:
+            send_pickup()
+        else:
+            # Send commands to the rover!
+            send_control(response[1], response[2], response[3])
 
 @sio.on('connect')
 def connect(sid, environ):
@@ -202,7 +181,117 @@ if __name__ == '__main__':
         default='',
         help='Path to image folder. This is where the images from the run will be saved.'
     )
+    parser.add_argument(
+        '--world-size',
+        type=int,
+        default=200,
+        help='Size in meters of the square worldmap.'
+    )
+    parser.add_argument(
+        '--tiled-map',
+        action='store_true',
+        help='Use an unbounded worldmap whose tiles are allocated as the rover explores.'
+    )
+    parser.add_argument(
+        '--map-spill',
+        type=str,
+        default=None,
+        help='Folder to keep the tiles of the tiled worldmap in as memory mapped files.'
+    )
+    parser.add_argument(
+        '--pipelined',
+        action='store_true',
+        help='Run perception and decision on a worker thread that only keeps the newest frame.'
+    )
+    parser.add_argument(
+        '--max-lag',
+        type=int,
+        default=10,
+        help='With --pipelined send null commands instead of a decision made this many frames ago or more.'
+    )
+    parser.add_argument(
+        '--max-age',
+        type=float,
+        default=1.0,
+        help='With --pipelined send null commands instead of a decision older than this many seconds.'
+    )
+    parser.add_argument(
+        '--adaptive',
+        action='store_true',
+        help='Skip perception on frames where the rover did not move or turn, reusing the last results.'
+    )
+    parser.add_argument(
+        '--roi',
+        action='store_true',
+        help='Only warp, threshold and project the part of the frame the camera sees the ground in.'
+    )
+    parser.add_argument(
+        '--downsample',
+        type=int,
+        default=1,
+        help='Run perception on every n-th row and column of the warped frame, the pixel count thresholds are scaled to match.'
+    )
+    parser.add_argument(
+        '--full-res-map',
+        action='store_true',
+        help='With --downsample keep updating the worldmap at full resolution, only the navigable pixels for decision are thinned out.'
+    )
+    parser.add_argument(
+        '--inset-rate',
+        type=float,
+        default=0,
+        help='Refresh the inset images this many times a second on a background thread, 0 encodes them on every frame.'
+    )
+    parser.add_argument(
+        '--inset-quality',
+        type=int,
+        default=75,
+        help='JPEG quality of the inset images refreshed in the background.'
+    )
+    parser.add_argument(
+        '--inset-scale',
+        type=float,
+        default=1.0,
+        help='Scale of the inset images refreshed in the background.'
+    )
+    parser.add_argument(
+        '--log-level',
+        type=str,
+        default='INFO',
+        help='Level of the telemetry status log (DEBUG, INFO, WARNING, ...).'
+    )
+    parser.add_argument(
+        '--profile',
+        type=str,
+        default='',
+        help='Time every stage of the drive loop and write their latency percentiles to this .json or .csv file.'
+    )
+    parser.add_argument(
+        '--profile-interval',
+        type=float,
+        default=10.0,
+        help='Seconds between writes of the profile, it is also written on exit.'
+    )
     args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.profile != '':
+        profiler.enable(args.profile, args.profile_interval)
+    if args.pipelined:
+        pipeline = LatestFrameWorker(drive, args.max_lag, args.max_age)
+    if args.adaptive:
+        scheduler = PerceptionScheduler()
+    perception.ROI_MODE = args.roi
+    if args.downsample > 1:
+        Rover.scale_thresholds(perception.set_resolution(args.downsample, args.full_res_map))
+    if args.inset_rate > 0:
+        inset_encoder = InsetEncoder(args.inset_rate, args.inset_quality, args.inset_scale)
+
+    if args.tiled_map:
+        Rover.worldmap = TiledOccupancyGrid(spill_dir=args.map_spill)
+    elif args.world_size != Rover.worldmap.world_size:
+        Rover.worldmap = OccupancyGrid(args.world_size)
     
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
@@ -212,6 +301,8 @@ if __name__ == '__main__':
         else:
             shutil.rmtree(args.image_folder)
             os.makedirs(args.image_folder)
+        recorder = RunRecorder(args.image_folder)
+        atexit.register(recorder.stop)
         print("Recording this run ...")
     else:
         print("NOT recording this run ...")
@@ -0,0 +1,126 @@
+# Size bounded LRU cache of per frame intermediate images (the decoded RGB
+# image, the warped image, ...) for tuning loops that run the same frames
+# through perception over and over. Entries pushed out of memory can be
+# spilled to .npy files in spill_dir and are loaded back from there
+# Example: $ python framecache.py --passes 3 --max-mb 16   (report the hit rates)
+import argparse
+import hashlib
+import os
+import time
+from collections import OrderedDict
+import numpy as np
+
+import perception
+from replay import load_image
+from runlog import read_log, resolve_image
+
+class FrameCache():
+    def __init__(self, max_bytes=256 * 1024 * 1024, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.entries = OrderedDict() # key -> array, least recently used first
+        self.nbytes = 0
+        self.warps = {} # warp points -> WarpEngine
+        self.hits = 0
+        self.misses = 0
+        self.spill_hits = 0
+        self.evictions = 0
+
+    # The cached value of key, computed with compute() when it is not cached
+    # cached arrays are read only since every user of the key shares them
+    def get(self, key, compute):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+        path = self.spill_path(key)
+        if path is not None and os.path.exists(path):
+            self.spill_hits += 1
+            value = np.load(path)
+        else:
+            self.misses += 1
+            value = np.asarray(compute())
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        value.flags.writeable = False
+        self.entries[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            old_key, old_value = self.entries.popitem(last=False)
+            self.nbytes -= old_value.nbytes
+            self.evictions += 1
+            path = self.spill_path(old_key)
+            if path is not None and not os.path.exists(path):
+                np.save(path, old_value)
+
+    # file an entry is spilled to, None without a spill_dir
+    def spill_path(self, key):
+        if self.spill_dir is None:
+            return None
+        return os.path.join(self.spill_dir, hashlib.sha1(repr(key).encode()).hexdigest() + '.npy')
+
+    # the decoded RGB image of the image file at path
+    def image(self, path):
+        return self.get((path, 'rgb'), lambda: load_image(path))
+
+    # the image at path warped with the src and dst points the way perception_step warps
+    def warped(self, path, src=None, dst=None):
+        src = perception.src if src is None else np.float32(src)
+        dst = perception.dest if dst is None else np.float32(dst)
+        points = src.tobytes() + dst.tobytes()
+        if points not in self.warps:
+            self.warps[points] = perception.WarpEngine(src, dst, perception.IMG_SHAPE)
+        warp = self.warps[points]
+        # the engine warps into a shared buffer so the cache keeps a copy
+        return self.get((path, 'warp', points), lambda: warp.warp(self.image(path)).copy())
+
+    # hit and miss counts, the spill hits are counted apart from the memory hits
+    def stats(self):
+        lookups = self.hits + self.spill_hits + self.misses
+        return {'hits': self.hits, 'spill_hits': self.spill_hits, 'misses': self.misses,
+                'hit_rate': (self.hits + self.spill_hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions, 'entries': len(self.entries), 'nbytes': self.nbytes}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run threshold passes over a run through a FrameCache')
+    parser.add_argument(
+        'log',
+        type=str,
+        nargs='?',
+        default='../test_dataset/robot_log.csv',
+        help='Path to the robot_log.csv of the run.'
+    )
+    parser.add_argument(
+        '--passes',
+        type=int,
+        default=3,
+        help='Number of passes over the frames, each with a slightly different threshold.'
+    )
+    parser.add_argument(
+        '--max-mb',
+        type=float,
+        default=256,
+        help='Size of the cache in megabytes.'
+    )
+    parser.add_argument(
+        '--spill',
+        type=str,
+        default=None,
+        help='Folder to spill the entries that do not fit in memory to.'
+    )
+    args = parser.parse_args()
+
+    cache = FrameCache(int(args.max_mb * 1024 * 1024), args.spill)
+    paths = [resolve_image(args.log, row['Path']) for row in read_log(args.log)]
+    for tuning_pass in range(args.passes):
+        thresh = tuple(value + tuning_pass for value in perception.NAV_THRESH)
+        start = time.perf_counter()
+        for path in paths:
+            perception.CLASSIFIER.classify(cache.warped(path), thresh)
+        print('pass {} thresh {} {:.1f} ms'.format(tuning_pass, thresh, (time.perf_counter() - start) * 1000))
+    print(cache.stats())
@@ -1,6 +1,8 @@
 import numpy as np
 import cv2
 
+import profiler
+
 # Turn to true for debuggin mode, shows the pipeline on the left of the simulator's screen
 DEBUGING_MODE = True
 
@@ -22,14 +24,27 @@ def color_thresh(img, rgb_thresh=(160, 160, 160)):
 
 # Define a function to convert from image coords to rover coords
 def rover_coords(binary_img):
+    # the camera frame has a fixed size so the coordinates come from the cached grids
+    if binary_img.shape == ROVER_X.shape:
+        mask = binary_img != 0
+        return ROVER_X[mask], ROVER_Y[mask]
     # Identify nonzero pixels
     ypos, xpos = binary_img.nonzero()
     # Calculate pixel positions with reference to the rover position being at the 
     # center bottom of the image.  
-    x_pixel = -(ypos - binary_img.shape[0]).astype(np.float)
-    y_pixel = -(xpos - binary_img.shape[1]/2 ).astype(np.float)
+    x_pixel = -(ypos - binary_img.shape[0]).astype(np.float32)
+    y_pixel = -(xpos - binary_img.shape[1]/2 ).astype(np.float32)
     return x_pixel, y_pixel
 
+# Build the rover coordinates, distance and angle of every pixel of an image
+# of the given shape, the same values rover_coords and to_polar_coords give
+def rover_grids(shape):
+    ypos, xpos = np.mgrid[0:shape[0], 0:shape[1]]
+    x_grid = -(ypos - shape[0]).astype(np.float32)
+    y_grid = -(xpos - shape[1]/2).astype(np.float32)
+    dist_grid, angle_grid = to_polar_coords(x_grid, y_grid)
+    return x_grid, y_grid, dist_grid, angle_grid
+
 
 # Define a function to convert to radial coords in rover space
 def to_polar_coords(x_pixel, y_pixel):
@@ -66,6 +81,9 @@ def pix_to_world(xpix, ypix, xpos, ypos, yaw, world_size, scale):
     xpix_rot, ypix_rot = rotate_pix(xpix, ypix, yaw)
     # Apply translation
     xpix_tran, ypix_tran = translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale)
+    # an unbounded (tiled) map has no world_size and is not clipped
+    if world_size is None:
+        return np.int_(np.floor(xpix_tran)), np.int_(np.floor(ypix_tran))
     # Perform rotation, translation and clipping all at once
     x_pix_world = np.clip(np.int_(xpix_tran), 0, world_size - 1)
     y_pix_world = np.clip(np.int_(ypix_tran), 0, world_size - 1)
@@ -78,9 +96,37 @@ def perspect_transform(img, src, dst):
     warped = cv2.warpPerspective(img, M, (img.shape[1], img.shape[0]))# keep same size as input image
     return warped
 
+# A perspective warp that is built once for a fixed camera geometry
+# The homography and the remap tables are computed in the constructor so that
+# every frame only pays for a single cv2.remap over the rows from top onwards
+class WarpEngine():
+    def __init__(self, src, dst, shape, top=0):
+        self.shape = shape
+        self.top = top
+        self.M = cv2.getPerspectiveTransform(src, dst)
+        # for every pixel of the warped band find where it comes from in the camera image
+        rows, cols = shape[0] - top, shape[1]
+        xs, ys = np.meshgrid(np.arange(cols, dtype=np.float32),
+                             np.arange(top, shape[0], dtype=np.float32))
+        pts = np.dstack((xs, ys)).reshape(-1, 1, 2)
+        src_pts = cv2.perspectiveTransform(pts, np.linalg.inv(self.M)).reshape(rows, cols, 2)
+        self.map_x = np.ascontiguousarray(src_pts[:, :, 0])
+        self.map_y = np.ascontiguousarray(src_pts[:, :, 1])
+        # fixed point maps are noticeably faster to remap with than float ones
+        self.map1, self.map2 = cv2.convertMaps(self.map_x, self.map_y, cv2.CV_16SC2)
+        # the rows above top are never written so they stay black
+        self.out = np.zeros(shape, dtype=np.uint8)
+
+    # warp img into the reused output buffer and return it
+    def warp(self, img):
+        cv2.remap(img, self.map1, self.map2, cv2.INTER_LINEAR, dst=self.out[self.top:],
+                  borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        return self.out
+
 # a function that scales an image down in size by a factor of scale
-def scale_img(img, scale):
-    res = cv2.resize(img, dsize=(int(img.shape[1]/scale), int(img.shape[0]/scale)), interpolation=cv2.INTER_CUBIC)
+# the result is written into dst when one of the right size is given
+def scale_img(img, scale, dst=None):
+    res = cv2.resize(img, dsize=(int(img.shape[1]/scale), int(img.shape[0]/scale)), dst=dst, interpolation=cv2.INTER_CUBIC)
     return res
 
 # This function ignores far awary obstacles
@@ -90,16 +136,16 @@ def ignoreFar(obs_x, obs_y):
     return obs_x[faraway], obs_y[faraway]
 
 # a function that plots the xpix and ypix of the rover coordinates in an image and shows their mean dir
-def x_y_to_img(xpix, ypix, Rover):
-    # create a blank image
-    blank=np.zeros([321,161,3])
-    # loop over the x and y values
-    for idx, x in np.ndenumerate(xpix):
-        # turn the x and y values of rover coordinates to valid image coordinates
-        x = int(160 - ypix[idx])
-        y = int(xpix[idx])
-        # color the x and y in the image white
-        blank[x,y,:] = 255
+# the image is drawn into a reused uint8 canvas unless out is given
+def x_y_to_img(xpix, ypix, Rover, out=None):
+    if out is None:
+        out = DEBUG_CANVAS
+    out[:] = 0
+    # turn the x and y values of rover coordinates to valid image coordinates
+    # and color them all white at once
+    rows = (160 - ypix).astype(np.intp)
+    cols = xpix.astype(np.intp)
+    out[rows, cols, :] = 255
     # turn the mean angle to a vector and scale it to be seen if Rover.nav_angles not None
     if Rover.nav_angles is not None and len(Rover.nav_angles) > 0:
         mean_dir = np.mean(Rover.nav_angles)
@@ -108,30 +154,16 @@ def x_y_to_img(xpix, ypix, Rover):
         # turn the mean vector from rover coordinates to image coordinates
         x = int(160 - y_rov)
         y = int(x_rov)
-        # plot a square cetnered around the mean vector so the direction can be seen visually
-        for i in range(5):
-            for j in range(5):
-                blank[np.clip(x + i, 0, 320), np.clip(y + j, 0,160), :] = [255, 0,0]
-                blank[np.clip(x + i, 0, 320), np.clip(y + j, 0,160), :] = [255, 0,0]
-                blank[np.clip(x - i, 0, 320), np.clip(y + j, 0,160), :] = [255, 0,0]
-                blank[np.clip(x - i, 0, 320), np.clip(y + j, 0,160), :] = [255, 0,0]
-    return blank
+        # draw an arrow from the rover to the mean direction so it can be seen visually
+        cv2.arrowedLine(out, (0, 160), (y, x), (255, 0, 0), 2, tipLength=0.3)
+    return out
 
 # This is a color threshholding function
 # That returns 1 if the pixel belongs to a rock
-def thresh_rock(img):
-    # first remove mountain
-    remove_mountain = np.zeros_like(img[:,:,:])
-    rgb_thresh = (100,100,0)
-    above_thresh = (img[:,:,0] > rgb_thresh[0]) \
-                & (img[:,:,1] > rgb_thresh[1]) \
-                & (img[:,:,2] > rgb_thresh[2])
-    for idx, x in np.ndenumerate(remove_mountain):
-        if above_thresh[idx[0], idx[1]] == 1:
-            remove_mountain[idx[0], idx[1]] = img[idx[0], idx[1]]
-    # Then separate between the rock and the ground
-    rgb_thresh = (100,100,50)
-    rock_select = np.zeros_like(remove_mountain[:,:,0])
+def thresh_rock(img, rgb_thresh=(100,100,50)):
+    # Rocks are yellow, bright in red and green but dark in blue
+    # which also separates them from the mountains and the ground
+    rock_select = np.zeros_like(img[:,:,0])
     above_thresh = (img[:,:,0] > rgb_thresh[0]) \
                 & (img[:,:,1] > rgb_thresh[1]) \
                 & (img[:,:,2] < rgb_thresh[2])
@@ -156,74 +188,549 @@ def obs_thresh(img, rgb_thresh=(160, 160, 160)):
     # Return the binary image
     return color_select
 
+# Label bits of the packed image returned by TerrainClassifier
+OBSTACLE = 1
+ROCK = 2
+NAVIGABLE = 4
+
+# Classifies every pixel as navigable/obstacle/rock with table lookups
+# All of the threshold rules are a logical and of one test per channel, so the
+# full RGB lookup table factors exactly into one 256 entry table per channel
+# a pixel's label is then lut_r[r] & lut_g[g] & lut_b[b]
+class TerrainClassifier():
+    # obstacles are the pixels below obs_thresh, the navigable threshold when it is None
+    def __init__(self, rock_thresh=(100,100,50), shape=(160, 320), obs_thresh=None):
+        self.rock_thresh = rock_thresh
+        self.obs_thresh = obs_thresh
+        # tables are cached per threshold so switching them costs nothing
+        self.luts = {}
+        self.labels = np.zeros(shape[:2], dtype=np.uint8)
+        # the per channel labels of every pixel before they are combined
+        self.channels = np.zeros(shape[:2] + (3,), dtype=np.uint8)
+
+    # build (or fetch) the label tables for a threshold, one per channel
+    # stacked as a (256, 1, 3) table for cv2.LUT
+    def tables(self, rgb_thresh):
+        if rgb_thresh not in self.luts:
+            values = np.arange(256)
+            obs_thresh = rgb_thresh if self.obs_thresh is None else self.obs_thresh
+            luts = np.zeros((256, 1, 3), dtype=np.uint8)
+            for c in range(3):
+                lut = luts[:, 0, c]
+                lut[values > rgb_thresh[c]] |= NAVIGABLE
+                lut[(values < obs_thresh[c]) & (values > 0)] |= OBSTACLE
+                if c < 2:
+                    lut[values > self.rock_thresh[c]] |= ROCK
+                else:
+                    lut[values < self.rock_thresh[c]] |= ROCK
+            self.luts[rgb_thresh] = luts
+        return self.luts[rgb_thresh]
+
+    # return the packed uint8 label image of img, written into out when it is given
+    # one cv2.LUT looks up all three channels into the reused channels buffer
+    # (np.take would first convert the image to an index array), and the
+    # channel labels are combined in place
+    def classify(self, img, rgb_thresh, out=None):
+        luts = self.tables(tuple(rgb_thresh))
+        labels = self.labels[:img.shape[0], :img.shape[1]] if out is None else out
+        channels = self.channels[:img.shape[0], :img.shape[1]]
+        cv2.LUT(img, luts, dst=channels)
+        np.bitwise_and(channels[:,:,0], channels[:,:,1], out=labels)
+        np.bitwise_and(labels, channels[:,:,2], out=labels)
+        return labels
+
+# Split a packed label image into the navigable, rock and obstacle binary images
+# written into out (a (3, rows, cols) uint8 array) when it is given
+def split_labels(labels, out=None):
+    if out is None:
+        return labels >> 2, (labels >> 1) & 1, labels & OBSTACLE
+    np.right_shift(labels, 2, out=out[0])
+    np.right_shift(labels, 1, out=out[1])
+    np.bitwise_and(out[1], 1, out=out[1])
+    np.bitwise_and(labels, OBSTACLE, out=out[2])
+    return out[0], out[1], out[2]
+
+
+# Owns the scratch buffers of perception_step, sized for the camera image
+# Every stage writes its results into these buffers with out= instead of
+# allocating them each frame. Some temporaries remain: np.compress builds
+# an index array of the selected pixels internally (8 bytes per pixel) and
+# the worldmap update counts unique cells. The arrays the methods return
+# are views into the buffers that are only valid until the next frame
+class PerceptionContext():
+    # indices of the binary images in masks and the coordinate buffers
+    NAV, ROCK, OBS, NEAR_OBS = 0, 1, 2, 3
+
+    def __init__(self, shape=(160, 320, 3)):
+        rows, cols = shape[:2]
+        capacity = rows * cols
+        # navigable, rock and obstacle binary images (0 or 1)
+        self.masks = np.zeros((3, rows, cols), dtype=np.uint8)
+        # rover coordinates of the pixels of every binary image
+        self.rover_x = np.zeros((3, capacity), dtype=np.float32)
+        self.rover_y = np.zeros((3, capacity), dtype=np.float32)
+        # world coordinates of the same pixels, plus the obstacles that are close enough
+        self.world_x = np.zeros((4, capacity), dtype=np.int_)
+        self.world_y = np.zeros((4, capacity), dtype=np.int_)
+        # polar coordinates of the navigable pixels
+        self.dists = np.zeros(capacity, dtype=np.float32)
+        self.angles = np.zeros(capacity, dtype=np.float32)
+        self.scratch_a = np.zeros(capacity, dtype=np.float64)
+        self.scratch_b = np.zeros(capacity, dtype=np.float64)
+        self.keep = np.zeros(capacity, dtype=bool)
+        # debugging view images, scaled down by 2
+        self.mask_255 = np.zeros((rows, cols), dtype=np.uint8)
+        self.small_warped = np.zeros((rows // 2, cols // 2, 3), dtype=np.uint8)
+        self.small_mask = np.zeros((rows // 2, cols // 2), dtype=np.uint8)
+        self.small_rover = np.zeros((DEBUG_CANVAS.shape[0] // 2, DEBUG_CANVAS.shape[1] // 2, 3), dtype=np.uint8)
+
+    # binary images of 0 and 1 are read as booleans without a copy
+    def as_bool(self, binary_img):
+        if binary_img.dtype == bool:
+            return binary_img.ravel()
+        if binary_img.dtype == np.uint8 and binary_img.flags['C_CONTIGUOUS']:
+            return binary_img.view(bool).ravel()
+        return (binary_img != 0).ravel()
+
+    # rover_coords of a camera sized binary image into the idx buffers
+    # other pixel sets pass the rover coordinates of their pixels as x_grid and y_grid
+    def rover_pixels(self, binary_img, idx, x_grid=None, y_grid=None):
+        if x_grid is None:
+            x_grid, y_grid = ROVER_X, ROVER_Y
+        mask = self.as_bool(binary_img)
+        count = np.count_nonzero(mask)
+        xpix, ypix = self.rover_x[idx, :count], self.rover_y[idx, :count]
+        np.compress(mask, x_grid.ravel(), out=xpix)
+        np.compress(mask, y_grid.ravel(), out=ypix)
+        return xpix, ypix
+
+    # pix_to_world of the rover coordinates in the idx buffers
+    def world_pixels(self, idx, count, xpos, ypos, yaw, world_size, scale):
+        xpix, ypix = self.rover_x[idx, :count], self.rover_y[idx, :count]
+        x_world, y_world = self.world_x[idx, :count], self.world_y[idx, :count]
+        a, b = self.scratch_a[:count], self.scratch_b[:count]
+        yaw_rad = yaw * np.pi / 180
+        cos_yaw, sin_yaw = np.cos(yaw_rad), np.sin(yaw_rad)
+        # rotation, scaling and translation of x then y
+        np.multiply(xpix, cos_yaw, out=a)
+        np.multiply(ypix, sin_yaw, out=b)
+        np.subtract(a, b, out=a)
+        np.divide(a, scale, out=a)
+        np.add(a, xpos, out=a)
+        self.to_cells(a, x_world, world_size)
+        np.multiply(xpix, sin_yaw, out=a)
+        np.multiply(ypix, cos_yaw, out=b)
+        np.add(a, b, out=a)
+        np.divide(a, scale, out=a)
+        np.add(a, ypos, out=a)
+        self.to_cells(a, y_world, world_size)
+        return x_world, y_world
+
+    # cast world coordinates to cells the same way pix_to_world does
+    def to_cells(self, coords, cells, world_size):
+        if world_size is None:
+            np.floor(coords, out=coords)
+            cells[:] = coords
+        else:
+            # the cast truncates like np.int_ before clipping
+            cells[:] = coords
+            np.clip(cells, 0, world_size - 1, out=cells)
+
+    # ignoreFar of the obstacle world coordinates into the NEAR_OBS buffers
+    def near_obstacles(self, count):
+        obs_x, obs_y = self.world_x[self.OBS, :count], self.world_y[self.OBS, :count]
+        dist = self.scratch_a[:count]
+        np.multiply(obs_x, obs_x, out=dist)
+        np.add(dist, np.square(obs_y, out=self.scratch_b[:count]), out=dist)
+        np.sqrt(dist, out=dist)
+        np.divide(dist, 10, out=dist)
+        faraway = np.less(dist, 8, out=self.keep[:count])
+        near = np.count_nonzero(faraway)
+        near_x, near_y = self.world_x[self.NEAR_OBS, :near], self.world_y[self.NEAR_OBS, :near]
+        np.compress(faraway, obs_x, out=near_x)
+        np.compress(faraway, obs_y, out=near_y)
+        return near_x, near_y
+
+    # to_polar_coords of the rover coordinates of the navigable binary image
+    def polar(self, binary_img, dist_grid=None, angle_grid=None):
+        if dist_grid is None:
+            dist_grid, angle_grid = ROVER_DIST, ROVER_ANGLE
+        mask = self.as_bool(binary_img)
+        count = np.count_nonzero(mask)
+        np.compress(mask, dist_grid.ravel(), out=self.dists[:count])
+        np.compress(mask, angle_grid.ravel(), out=self.angles[:count])
+        return self.dists[:count], self.angles[:count]
+
+# The part of the warped frame the camera actually sees the ground in
+# Every other warped pixel is black, so it is never navigable, rock or obstacle.
+# The region is found once from the warp geometry and the frames are then
+# warped, thresholded and projected only on its pixels, kept as a flat list.
+# Obstacles further than max_dist rover pixels (ignoreFar's 8 meters) are
+# dropped in rover space before they are projected into the world.
+# A step above 1 only processes every step-th row and column of the frame,
+# a nav_step above 1 keeps the full resolution for the worldmap and only
+# thins out the navigable pixels handed to decision_step (nav_angles/nav_dists).
+# The coordinates stay in full resolution rover pixels either way
+class GroundROI():
+    # the pixels are laid out in rows of this width, remap only takes maps
+    # shorter than 32767 pixels
+    ROW = 256
+
+    def __init__(self, warp, context, max_dist=80, step=1, nav_step=1):
+        rows, cols = warp.shape[:2]
+        self.context = context
+        self.shape = warp.shape
+        self.step = step
+        self.nav_step = nav_step
+        # the ground is where the bilinear interpolation of the warp touches the camera image
+        valid = (warp.map_x > -1) & (warp.map_x < cols) & (warp.map_y > -1) & (warp.map_y < rows)
+        valid &= self.sampled(warp, step)
+        band_y, band_x = np.nonzero(valid)
+        # flat index in the frame of every ground pixel
+        self.index = (band_y + warp.top) * cols + band_x
+        self.size = len(self.index)
+        # padding pixels sample far outside the camera image so they stay black
+        padded = -(-self.size // self.ROW) * self.ROW
+        map_x = np.full(padded, -10, dtype=np.float32)
+        map_y = np.full(padded, -10, dtype=np.float32)
+        map_x[:self.size] = warp.map_x[valid]
+        map_y[:self.size] = warp.map_y[valid]
+        self.map1, self.map2 = cv2.convertMaps(map_x.reshape(-1, self.ROW), map_y.reshape(-1, self.ROW),
+                                               cv2.CV_16SC2)
+        # rover and polar coordinates of the ground pixels
+        self.x, self.y, self.dist, self.angle = (np.zeros(padded, dtype=np.float32) for _ in range(4))
+        for grid, coords in ((ROVER_X, self.x), (ROVER_Y, self.y), (ROVER_DIST, self.dist),
+                             (ROVER_ANGLE, self.angle)):
+            coords[:self.size] = grid.ravel()[self.index]
+        self.near = (self.dist < max_dist).view(np.uint8)
+        # navigable terrain is only looked for below CLIP_WARP, like threshold_frame does
+        self.nav_band = np.zeros(padded, dtype=np.uint8)
+        self.nav_band[:self.size] = self.index >= CLIP_WARP * cols
+        # the ground pixels that make up the navigable pixel set
+        self.nav_index = np.flatnonzero(self.sampled(warp, nav_step)[valid])
+        self.nav_dist = np.ascontiguousarray(self.dist[self.nav_index])
+        self.nav_angle = np.ascontiguousarray(self.angle[self.nav_index])
+        self.nav_mask = np.zeros(len(self.nav_index), dtype=np.uint8)
+        self.pixels = np.zeros((padded // self.ROW, self.ROW, 3), dtype=np.uint8)
+        self.classifier = TerrainClassifier(shape=self.pixels.shape)
+        self.masks = np.zeros((3,) + self.pixels.shape[:2], dtype=np.uint8)
+        self.near_obs = np.zeros(padded, dtype=np.uint8)
+        # full frames for the vision image, only the ground pixels are ever written
+        self.frame_warped = np.zeros(warp.shape, dtype=np.uint8)
+        self.frame_masks = np.zeros((3,) + warp.shape[:2], dtype=np.uint8)
+
+    # which pixels of the warped band are kept when sampling every step-th row and column
+    @staticmethod
+    def sampled(warp, step):
+        band_y, band_x = np.mgrid[warp.top:warp.shape[0], 0:warp.shape[1]]
+        return (band_y % step == 0) & (band_x % step == 0)
+
+    # threshold_frame on the ground pixels only
+    # the warped frame is only filled in with full_warp (it is only shown in the debugging view)
+    def threshold_frame(self, image, pitch, full_warp=False):
+        with profiler.stage('warp'):
+            self.warp(image)
+            if full_warp:
+                self.frame_warped.reshape(-1, 3)[self.index] = self.pixels.reshape(-1, 3)[:self.size]
+        thresh, ignored_img = frame_thresh(pitch)
+        with profiler.stage('threshold'):
+            self.threshold(self.pixels, thresh)
+        return self.frame_warped, self.frame_masks[0], self.frame_masks[1], self.frame_masks[2], ignored_img
+
+    # warp the ground pixels of a camera image into the reused pixel buffer and return it
+    def warp(self, image):
+        cv2.remap(image, self.map1, self.map2, cv2.INTER_LINEAR, dst=self.pixels,
+                  borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        return self.pixels
+
+    # classify warped ground pixels into the masks map_frame and polar use
+    # with another classifier for other rock or obstacle thresholds, the full
+    # frame masks of the vision image are only filled in with frames
+    def threshold(self, pixels, thresh, classifier=None, frames=True):
+        labels = (classifier or self.classifier).classify(pixels, thresh)
+        split_labels(labels, out=self.masks)
+        nav = self.masks[0].ravel()
+        np.bitwise_and(nav, self.nav_band, out=nav)
+        if frames:
+            for mask, frame in zip(self.masks, self.frame_masks):
+                frame.ravel()[self.index] = mask.ravel()[:self.size]
+
+    # map_frame of the ground pixels thresholded by the last threshold_frame
+    def map_frame(self, worldmap, pos, yaw, roll, stats=None, samples_pos=None, update=True):
+        ctx = self.context
+        nav, rock, obs = (mask.ravel() for mask in self.masks)
+        with profiler.stage('coords'):
+            xpix, ypix = ctx.rover_pixels(nav, ctx.NAV, self.x, self.y)
+            rov_rock_x, _ = ctx.rover_pixels(rock, ctx.ROCK, self.x, self.y)
+            np.bitwise_and(obs, self.near, out=self.near_obs)
+            rov_obs_x, _ = ctx.rover_pixels(self.near_obs, ctx.OBS, self.x, self.y)
+            xpix_world, ypix_world = ctx.world_pixels(ctx.NAV, len(xpix), pos[0], pos[1], yaw, worldmap.world_size, dst_size*2)
+            obs_x, obs_y = ctx.world_pixels(ctx.OBS, len(rov_obs_x), pos[0], pos[1], yaw, worldmap.world_size, dst_size*2)
+            rock_x, rock_y = ctx.world_pixels(ctx.ROCK, len(rov_rock_x), pos[0], pos[1], yaw, worldmap.world_size, dst_size*2)
+        if update:
+            add_to_map(worldmap, xpix_world, ypix_world, rock_x, rock_y, obs_x, obs_y, roll, stats, samples_pos)
+        return xpix, ypix, rock_x, rock_y
+
+    # polar coordinates of the navigable ground pixels
+    def polar(self):
+        nav = self.masks[0].ravel()
+        if self.nav_step > 1:
+            nav = np.take(nav, self.nav_index, out=self.nav_mask)
+        return self.context.polar(nav, self.nav_dist, self.nav_angle)
+
+# Camera geometry, the simulator camera never moves relative to the rover
+IMG_SHAPE = (160, 320, 3)
+# Remove Part of the warped image to ignore the sky
+CLIP_WARP = 80
+dst_size = 5
+bottom_offset = 6
+# 1) Define source and destination points for perspective transform
+src = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
+dest = np.float32([[IMG_SHAPE[1]/2 - dst_size, IMG_SHAPE[0] - bottom_offset],
+                  [IMG_SHAPE[1]/2 + dst_size, IMG_SHAPE[0] - bottom_offset],
+                  [IMG_SHAPE[1]/2 + dst_size, IMG_SHAPE[0] - 2*dst_size - bottom_offset],
+                  [IMG_SHAPE[1]/2 - dst_size, IMG_SHAPE[0] - 2*dst_size - bottom_offset],
+                  ])
+# Color threshold of navigable terrain
+NAV_THRESH = (137,175,134)
+# The whole frame is warped, rocks and obstacles are looked for above CLIP_WARP too
+WARP = WarpEngine(src, dest, IMG_SHAPE)
+CLASSIFIER = TerrainClassifier()
+# Canvas x_y_to_img draws the debugging view of the rover coordinates into
+DEBUG_CANVAS = np.zeros((321, 161, 3), dtype=np.uint8)
+# Per pixel rover coordinates and polar coordinates of the warped frame
+ROVER_X, ROVER_Y, ROVER_DIST, ROVER_ANGLE = rover_grids(IMG_SHAPE[:2])
+# Scratch buffers of perception_step
+CONTEXT = PerceptionContext(IMG_SHAPE)
+# Turn to true to only process the ground the camera sees, see GroundROI
+ROI_MODE = False
+ROI = GroundROI(WARP, CONTEXT)
+
+# Run perception on every step-th row and column of the warped frame, 1/step
+# of the full resolution, through the ground region of interest. With full_map
+# the worldmap keeps being updated at full resolution and only the navigable
+# pixels decision_step gets are thinned out.
+# returns the fraction of the navigable pixels that is kept, see RoverState.scale_thresholds
+def set_resolution(step, full_map=False):
+    global ROI, ROI_MODE
+    if full_map:
+        ROI = GroundROI(WARP, CONTEXT, nav_step=step)
+    else:
+        ROI = GroundROI(WARP, CONTEXT, step=step)
+    ROI_MODE = True
+    return 1.0 / (step * step)
+
+# The navigation threshold for a frame taken at pitch and whether the frame is ignored
+# if pitch is too high ignore image by turning the threshhold up to white
+def frame_thresh(pitch, nav_thresh=NAV_THRESH):
+    if pitch > 1:
+        return (255,255,255), True
+    return nav_thresh, False
+
+# Maps stacks of frames into the worldmap at once for offline processing
+# The frames of a chunk are warped by a single remap of the stacked images,
+# classified by a single table lookup and projected with per pixel poses, and
+# all of their pixels are counted with one bincount per channel that is added
+# to the worldmap in one merge. The worldmap ends up the same as with
+# perception_step in ROI_MODE, frame by frame, until a channel has to be
+# halved (see OccupancyGrid): frame by frame the frames before the halving
+# count half as much, the merge halves all of the frames alike
+class BatchMapper():
+    def __init__(self, roi=None, chunk=200):
+        roi = ROI if roi is None else roi
+        rows = roi.shape[0]
+        # frames are stacked on top of each other, the warp must not read
+        # across the edge of a frame into the next one
+        map_y = roi.map1.reshape(-1, 2)[:roi.size, 1]
+        if map_y.min() < 0 or map_y.max() >= rows - 1:
+            raise ValueError('the ground region touches the top or bottom edge of the camera image')
+        # the fixed point maps hold the rows of the stack in 16 bits
+        chunk = min(chunk, 32767 // rows - 1)
+        self.roi = roi
+        self.chunk = chunk
+        self.frame_rows = roi.pixels.shape[0]
+        self.frame_size = roi.pixels.shape[0] * roi.pixels.shape[1]
+        # the maps of frame k are those of the roi moved down k images
+        offsets = np.zeros((chunk, 1, 1, 2), dtype=np.int16)
+        offsets[:, 0, 0, 1] = np.arange(chunk) * rows
+        self.map1 = (roi.map1[np.newaxis] + offsets).reshape(-1, roi.map1.shape[1], 2)
+        self.map2 = np.tile(roi.map2, (chunk, 1))
+        self.pixels = np.zeros((chunk * self.frame_rows,) + roi.pixels.shape[1:], dtype=np.uint8)
+        self.classifier = TerrainClassifier(roi.classifier.rock_thresh, self.pixels.shape)
+        self.masks = np.zeros((3,) + self.pixels.shape[:2], dtype=np.uint8)
+
+    # Map images (N, 160, 320, 3) taken at poses, N rows of (x, y, yaw, pitch, roll),
+    # into worldmap (a fixed size OccupancyGrid), through stats when given
+    def map(self, worldmap, images, poses, stats=None, samples_pos=None):
+        if worldmap.world_size is None:
+            raise ValueError('batches can only be mapped into a fixed size worldmap')
+        # the stacked maps read the frames at fixed offsets, other sizes would read across frames
+        if np.shape(images)[1:] != tuple(self.roi.shape):
+            raise ValueError('images of shape {} do not match the camera shape {}'.format(
+                np.shape(images)[1:], tuple(self.roi.shape)))
+        world_size = worldmap.world_size
+        poses = np.asarray(poses, dtype=np.float64)
+        counts = np.zeros((3, world_size * world_size), dtype=np.int64)
+        # the frames ignored for their pitch are mapped after the others, so a
+        # chunk holds at most one run of each to classify, the counts add up
+        # the same in any order
+        order = np.argsort(poses[:, 3] > 1, kind='stable')
+        for start in range(0, len(images), self.chunk):
+            index = order[start:start + self.chunk]
+            # frames still in their order are sliced instead of copied
+            if np.array_equal(index, np.arange(index[0], index[0] + len(index))):
+                index = slice(index[0], index[0] + len(index))
+            self.count_chunk(counts, images[index], poses[index], world_size)
+        worldmap.merge(counts.T.reshape(world_size, world_size, 3))
+        if stats is not None:
+            stats.scan(worldmap, samples_pos)
+        return worldmap
+
+    # add the world cells of the pixels of a chunk of frames to counts
+    # the frames ignored for their pitch come after the others
+    def count_chunk(self, counts, images, poses, world_size):
+        roi, frames = self.roi, len(images)
+        pixels = self.pixels[:frames * self.frame_rows]
+        stack = np.ascontiguousarray(images).reshape(-1, images.shape[2], 3)
+        with profiler.stage('warp'):
+            cv2.remap(stack, self.map1[:len(pixels)], self.map2[:len(pixels)], cv2.INTER_LINEAR,
+                      dst=pixels, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        with profiler.stage('threshold'):
+            labels = self.classifier.labels[:len(pixels)]
+            # frames at a high pitch are ignored, see frame_thresh
+            split = np.count_nonzero(poses[:, 3] <= 1) * self.frame_rows
+            for part in (slice(0, split), slice(split, len(pixels))):
+                if part.stop > part.start:
+                    thresh, _ = frame_thresh(poses[part.start // self.frame_rows, 3])
+                    self.classifier.classify(pixels[part], thresh, out=labels[part])
+            labels = labels.reshape(frames, self.frame_size)
+        with profiler.stage('coords'):
+            masks = self.masks[:, :len(pixels)]
+            split_labels(labels.reshape(pixels.shape[:2]), out=masks)
+            masks = masks.reshape(3, frames, self.frame_size)
+            np.bitwise_and(masks[0], roi.nav_band, out=masks[0])
+            np.bitwise_and(masks[2], roi.near, out=masks[2])
+            # give more weight to descisions at low roll, the same steps as add_to_map
+            step = np.where(poses[:, 4] > 1, 1, 10)
+            yaw_rad = poses[:, 2] * np.pi / 180
+            # the cosines are taken one by one so they round exactly like world_pixels
+            cos_yaw = np.array([np.cos(angle) for angle in yaw_rad])
+            sin_yaw = np.array([np.sin(angle) for angle in yaw_rad])
+            for channel, mask, weight in ((2, masks[0], 5), (1, masks[1], 1), (0, masks[2], 1)):
+                mask = mask.view(bool)
+                found = np.flatnonzero(mask)
+                # the pixels are in frame order, so the values of each frame are
+                # repeated over as many pixels as it has
+                per_frame = np.count_nonzero(mask, axis=1)
+                pixel = found - np.repeat(np.arange(frames) * self.frame_size, per_frame)
+                xpix, ypix = roi.x[pixel], roi.y[pixel]
+                cos_pix, sin_pix = np.repeat(cos_yaw, per_frame), np.repeat(sin_yaw, per_frame)
+                # the same operations in the same order as world_pixels
+                x_world = xpix * cos_pix
+                x_world -= ypix * sin_pix
+                x_world /= dst_size*2
+                x_world += np.repeat(poses[:, 0], per_frame)
+                y_world = xpix * sin_pix
+                y_world += ypix * cos_pix
+                y_world /= dst_size*2
+                y_world += np.repeat(poses[:, 1], per_frame)
+                cells = np.clip(y_world.astype(np.int_), 0, world_size - 1, out=pixel)
+                cells *= world_size
+                cells += np.clip(x_world.astype(np.int_), 0, world_size - 1)
+                counts[channel] += np.bincount(cells, weights=np.repeat(step * weight, per_frame),
+                                               minlength=world_size * world_size).astype(np.int64)
+
+# Warp a camera image and apply the color thresholds to identify
+# navigable terrain/obstacles/rock samples
+def threshold_frame(image, pitch):
+    with profiler.stage('warp'):
+        warped = WARP.warp(image)
+    thresh, ignored_img = frame_thresh(pitch)
+    with profiler.stage('threshold'):
+        labels = CLASSIFIER.classify(warped, thresh)
+        threshold_img, threshhold_rock, threshhold_obs = split_labels(labels, out=CONTEXT.masks)
+        # Clip the navigable terrain in the upper portions of the photo as it is most likely the sky
+        threshold_img[0:CLIP_WARP,:] = 0
+    return warped, threshold_img, threshhold_rock, threshhold_obs, ignored_img
+
+# Project thresholded images taken at the given rover pose into the worldmap
+# through stats when given so the map statistics are kept up to date
+# with update False only the coordinates are computed and the map is left alone
+# returns the rover coordinates of the navigable pixels and the world coordinates of the rocks
+def map_frame(worldmap, threshold_img, threshhold_rock, threshhold_obs, pos, yaw, roll,
+              stats=None, samples_pos=None, update=True):
+    # 5) Convert map image pixel values to rover-centric coords
+    # all of the coordinates are written into the CONTEXT buffers
+    ctx = CONTEXT
+    with profiler.stage('coords'):
+        xpix, ypix = ctx.rover_pixels(threshold_img, ctx.NAV)
+        rov_rock_x, rov_rock_y = ctx.rover_pixels(threshhold_rock, ctx.ROCK)
+        rov_obs_x, rov_obs_y = ctx.rover_pixels(threshhold_obs, ctx.OBS)
+        # 6) Convert rover-centric pixel values to world coordinates
+        xpix_world, ypix_world = ctx.world_pixels(ctx.NAV, len(xpix), pos[0], pos[1], yaw, worldmap.world_size, dst_size*2)
+        ctx.world_pixels(ctx.OBS, len(rov_obs_x), pos[0], pos[1], yaw, worldmap.world_size, dst_size*2)
+        obs_x, obs_y = ctx.near_obstacles(len(rov_obs_x))
+        rock_x, rock_y = ctx.world_pixels(ctx.ROCK, len(rov_rock_x), pos[0], pos[1], yaw, worldmap.world_size, dst_size*2)
+    # 7) Update the worldmap
+    if update:
+        add_to_map(worldmap, xpix_world, ypix_world, rock_x, rock_y, obs_x, obs_y, roll, stats, samples_pos)
+    return xpix, ypix, rock_x, rock_y
+
+# Add the world coordinates of a frame taken at roll to the worldmap
+# through stats when given so the map statistics are kept up to date
+def add_to_map(worldmap, xpix_world, ypix_world, rock_x, rock_y, obs_x, obs_y, roll, stats=None, samples_pos=None):
+    # give more weight to descisions at low roll
+    step = 10
+    if roll > 1:
+        step = 1
+    with profiler.stage('map_update'):
+        if stats is None:
+            worldmap.add(2, ypix_world, xpix_world, step * 5)
+            worldmap.add(1, rock_y, rock_x, step)
+            worldmap.add(0, obs_y, obs_x, step)
+        else:
+            stats.add_navigable(worldmap, ypix_world, xpix_world, step * 5)
+            stats.add_rocks(worldmap, rock_y, rock_x, step, samples_pos)
+            stats.add_obstacles(worldmap, obs_y, obs_x, step)
 
 # Apply the above functions in succession and update the Rover state accordingly
-def perception_step(Rover):
+# update_map False leaves the worldmap as it is, see scheduler.py
+def perception_step(Rover, update_map=True):
     # Perform perception steps to update Rover()
-    # TODO:
     # NOTE: camera image is coming to you in Rover.img
-    CLIP_WARP = 80
-    # 1) Define source and destination points for perspective transform
-    image = Rover.img
-    # Remove Part of the warped image to ignore the sky
-    dst_size = 5
-    bottom_offset = 6 
-    src = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
-    dest = np.float32([[image.shape[1]/2 - dst_size, image.shape[0] - bottom_offset],
-                  [image.shape[1]/2 + dst_size, image.shape[0] - bottom_offset],
-                  [image.shape[1]/2 + dst_size, image.shape[0] - 2*dst_size - bottom_offset], 
-                  [image.shape[1]/2 - dst_size, image.shape[0] - 2*dst_size - bottom_offset],
-                  ])
-    # 2) Apply perspective transform
-    warped = perspect_transform(image, src, dest)
-    # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples
-    # if pitch is too high ignore image by turning the threshhold up to white
-    thresh = (137,175,134)
-    ignored_img = False
-    if Rover.pitch > 1:
-        ignored_img = True
-        thresh = (255,255,255)
-    threshold_img = color_thresh(warped, thresh)
-    threshhold_rock = thresh_rock(warped)
-    threshhold_obs = obs_thresh(warped, thresh)
-    # Clip the navigable terrain in the upper portions of the photo as it is most likely the sky
-    threshold_img[0:CLIP_WARP,:] = 0 
+    # 2) and 3) Warp the camera image and threshold it
+    if ROI_MODE:
+        warped, threshold_img, threshhold_rock, threshhold_obs, ignored_img = ROI.threshold_frame(
+            Rover.img, Rover.pitch, full_warp=DEBUGING_MODE)
+    else:
+        warped, threshold_img, threshhold_rock, threshhold_obs, ignored_img = threshold_frame(Rover.img, Rover.pitch)
     # 4) Update Rover.vision_image (this will be displayed on left side of screen)
         # Example: Rover.vision_image[:,:,0] = obstacle color-thresholded binary image
         #          Rover.vision_image[:,:,1] = rock_sample color-thresholded binary image
         #          Rover.vision_image[:,:,2] = navigable terrain color-thresholded binary image
     # moved to the bottom for debugging mode
 
-    # 5) Convert map image pixel values to rover-centric coords
-    xpix, ypix = rover_coords(threshold_img)
-    rov_obs_x, rov_obs_y = rover_coords(threshhold_obs)
-    rov_rock_x, rov_rock_y = rover_coords(threshhold_rock)
-    # 6) Convert rover-centric pixel values to world coordinates
-    xpix_world, ypix_world = pix_to_world(xpix, ypix, Rover.pos[0], Rover.pos[1], Rover.yaw, Rover.worldmap.shape[0], dst_size*2)
-    obs_x, obs_y = pix_to_world(rov_obs_x, rov_obs_y, Rover.pos[0], Rover.pos[1], Rover.yaw,Rover.worldmap.shape[0], dst_size*2)
-    obs_x, obs_y = ignoreFar(obs_x, obs_y)
-    rock_x, rock_y = pix_to_world(rov_rock_x, rov_rock_y, Rover.pos[0], Rover.pos[1], Rover.yaw,Rover.worldmap.shape[0], dst_size*2)
-
-    # 7) Update Rover worldmap (to be displayed on right side of screen)
-    # Example: Rover.worldmap[obstacle_y_world, obstacle_x_world, 0] += 1
-    #          Rover.worldmap[rock_y_world, rock_x_world, 1] += 1
-    #          Rover.worldmap[navigable_y_world, navigable_x_world, 2] += 1
-    # give more weight to descisions at low roll
-    step = 10
-    if Rover.roll > 1:
-        step = 1
-    Rover.worldmap[ypix_world, xpix_world, 2] += step * 5
-    Rover.worldmap[rock_y, rock_x, 1] += step
-    Rover.worldmap[obs_y, obs_x, 0] += step 
+    # 5) to 7) Update Rover worldmap (to be displayed on right side of screen)
+    # the map statistics are kept up to date with the pixels written each frame
+    if ROI_MODE:
+        xpix, ypix, rock_x, rock_y = ROI.map_frame(Rover.worldmap, Rover.pos, Rover.yaw, Rover.roll,
+                                                   Rover.map_stats, Rover.samples_pos, update_map)
+    else:
+        xpix, ypix, rock_x, rock_y = map_frame(Rover.worldmap, threshold_img, threshhold_rock, threshhold_obs,
+                                               Rover.pos, Rover.yaw, Rover.roll,
+                                               Rover.map_stats, Rover.samples_pos, update_map)
     # 8) Convert rover-centric pixel positions to polar coordinates
-    dist, angles = to_polar_coords(xpix, ypix)
+    if ROI_MODE:
+        dist, angles = ROI.polar()
+    else:
+        dist, angles = CONTEXT.polar(threshold_img)
     Rover.rock_dists, Rover.rock_angles = to_polar_coords(rock_x, rock_y)
     # Update Rover pixel distances and angles
     # Rover.nav_dists = rover_centric_pixel_distances
     # Rover.nav_angles = rover_centric_angles
     Rover.nav_dists = dist
     Rover.nav_angles = angles
-    if 1 in threshhold_rock:
+    if len(rock_x) > 0:
         Rover.rock_found = True
     # if image was intentionally ignored maintain previous angles
     # to keep robot going as it was
@@ -240,23 +747,19 @@ def perception_step(Rover):
         half_y = int(max_y-80)
 
         # show the Warped Image on the top left
-        Rover.vision_image[0:half_y,0:half_x, 2] = scale_img(warped[:,:,2], 2)
-        Rover.vision_image[0:half_y,0:half_x, 1] = scale_img(warped[:,:,1], 2)
-        Rover.vision_image[0:half_y,0:half_x, 0] = scale_img(warped[:,:,0], 2)
+        Rover.vision_image[0:half_y,0:half_x, :] = scale_img(warped, 2, dst=CONTEXT.small_warped)
 
         # show thes Threshholded image on the bottom left
-        Rover.vision_image[half_y:max_y,0:half_x, 0] = scale_img(threshhold_obs * 255, 2)
-        Rover.vision_image[half_y:max_y,0:half_x, 1] = scale_img(threshhold_rock * 255, 2)
-        Rover.vision_image[half_y:max_y,0:half_x, 2] = scale_img(threshold_img * 255, 2)
+        for channel, binary_img in ((0, threshhold_obs), (1, threshhold_rock), (2, threshold_img)):
+            np.multiply(binary_img, 255, out=CONTEXT.mask_255)
+            Rover.vision_image[half_y:max_y,0:half_x, channel] = scale_img(CONTEXT.mask_255, 2, dst=CONTEXT.small_mask)
 
         # show Rover Coordinates Image and the mean angle on the rightss
-        rover_img = scale_img(x_y_to_img(xpix, ypix, Rover), 2)
-        Rover.vision_image[:,half_x:half_x+80, 2] = rover_img[:,:,2]
-        Rover.vision_image[:,half_x:half_x+80, 1] = rover_img[:,:,1] 
-        Rover.vision_image[:,half_x:half_x+80, 0] = rover_img[:,:,0] 
+        rover_img = scale_img(x_y_to_img(xpix, ypix, Rover), 2, dst=CONTEXT.small_rover)
+        Rover.vision_image[:,half_x:half_x+80, :] = rover_img
     else:
-        Rover.vision_image[:,:, 0] = threshhold_obs * 255
-        Rover.vision_image[:,:, 1] = threshhold_rock * 255
-        Rover.vision_image[:,:, 2] = threshold_img * 255
+        np.multiply(threshhold_obs, 255, out=Rover.vision_image[:,:, 0])
+        np.multiply(threshhold_rock, 255, out=Rover.vision_image[:,:, 1])
+        np.multiply(threshold_img, 255, out=Rover.vision_image[:,:, 2])
 
     return Rover
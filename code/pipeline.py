@@ -0,0 +1,87 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger('rover')
+
+# Runs process on a worker thread, always on the newest submitted item
+# Items submitted while the worker is busy replace each other, so a slow
+# process drops stale frames instead of building up a backlog
+# An item process raises on gives a None result and the worker keeps going.
+# Results from an item submitted more than max_lag items ago or finished more
+# than max_age seconds ago are stale and latest reports None instead
+class LatestFrameWorker():
+    def __init__(self, process, max_lag=None, max_age=None):
+        self.process = process
+        self.max_lag = max_lag
+        self.max_age = max_age
+        self.condition = threading.Condition()
+        self.pending = None # newest item waiting to be processed
+        self.result = None # result of the last processed item
+        self.fresh = False # whether result was not handed out by latest yet
+        self.result_index = 0 # submitted count when the item of result was taken
+        self.result_time = None # when result was finished
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.stale = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # queue item for processing, replacing an item that is still waiting
+    def submit(self, item):
+        with self.condition:
+            if self.pending is not None:
+                self.dropped += 1
+            self.pending = item
+            self.submitted += 1
+            self.condition.notify()
+
+    # the latest result and whether it is new since the last call
+    # a stale result is reported as None
+    def latest(self):
+        with self.condition:
+            fresh = self.fresh
+            self.fresh = False
+            if self.result is not None and self.is_stale():
+                self.stale += 1
+                logger.warning('worker result is stale, %d items behind and %.2f s old',
+                               self.submitted - self.result_index, time.time() - self.result_time)
+                return None, False
+            return self.result, fresh
+
+    def is_stale(self):
+        if self.max_lag is not None and self.submitted - self.result_index > self.max_lag:
+            return True
+        return self.max_age is not None and time.time() - self.result_time > self.max_age
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                item = self.pending
+                self.pending = None
+                index = self.submitted
+            try:
+                result = self.process(item)
+            except Exception:
+                logger.exception('worker failed to process an item')
+                result = None
+                self.errors += 1
+            with self.condition:
+                self.result = result
+                self.fresh = True
+                self.result_index = index
+                self.result_time = time.time()
+                self.processed += 1
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
@@ -0,0 +1,100 @@
+# Per stage latency profiling of the drive loop
+# Stages are timed with `with profiler.stage('warp'):` which does nothing
+# until enable() is called, so the timing points can stay in the code
+import atexit
+import contextlib
+import csv
+import json
+import time
+import numpy as np
+
+# Keeps the last window durations of every stage in a ring buffer
+# and reports their percentiles
+class StageProfiler():
+    def __init__(self, window=1000, dump_path=None, dump_interval=10.0):
+        self.window = window
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self.last_dump = time.time()
+        self.samples = {} # stage -> ring buffer of durations in seconds
+        self.counts = {} # stage -> number of durations recorded
+
+    def record(self, name, seconds):
+        if name not in self.samples:
+            self.samples[name] = np.zeros(self.window)
+            self.counts[name] = 0
+        self.samples[name][self.counts[name] % self.window] = seconds
+        self.counts[name] += 1
+
+    def stage(self, name):
+        return StageTimer(self, name)
+
+    # count, mean and p50/p95/p99/max in milliseconds of the recent durations of every stage
+    def summary(self):
+        report = {}
+        for name, samples in self.samples.items():
+            ms = samples[:min(self.counts[name], self.window)] * 1000
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            report[name] = {'count': self.counts[name], 'mean_ms': float(np.mean(ms)),
+                            'p50_ms': float(p50), 'p95_ms': float(p95),
+                            'p99_ms': float(p99), 'max_ms': float(np.max(ms))}
+        return report
+
+    # write the summary as CSV if the path ends in .csv, as JSON otherwise
+    def dump(self, path=None):
+        path = path or self.dump_path
+        if path is None:
+            return
+        report = self.summary()
+        with open(path, 'w', newline='') as out:
+            if path.endswith('.csv'):
+                writer = csv.writer(out)
+                writer.writerow(['stage', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'])
+                for name, stats in report.items():
+                    writer.writerow([name, stats['count'], stats['mean_ms'], stats['p50_ms'],
+                                     stats['p95_ms'], stats['p99_ms'], stats['max_ms']])
+            else:
+                json.dump(report, out, indent=2)
+        self.last_dump = time.time()
+
+    # dump if dump_interval seconds passed since the last dump
+    def maybe_dump(self):
+        if self.dump_interval > 0 and time.time() - self.last_dump >= self.dump_interval:
+            self.dump()
+
+# Context manager timing one run of a stage
+class StageTimer():
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+# The profiler used by stage(), None while profiling is off
+PROFILER = None
+NO_STAGE = contextlib.nullcontext()
+
+def stage(name):
+    if PROFILER is None:
+        return NO_STAGE
+    return PROFILER.stage(name)
+
+# Turn profiling on, the summary is written to dump_path every dump_interval
+# seconds and when the program exits
+def enable(dump_path=None, dump_interval=10.0, window=1000):
+    global PROFILER
+    PROFILER = StageProfiler(window, dump_path, dump_interval)
+    atexit.register(PROFILER.dump)
+    return PROFILER
+
+def maybe_dump():
+    if PROFILER is not None:
+        PROFILER.maybe_dump()
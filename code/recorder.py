@@ -0,0 +1,78 @@
+# Records a run in the format of test_dataset: the camera images in an IMG
+# folder and their pose and controls in robot_log.csv, so it can be replayed
+# with replay.py. The socket handler only queues the telemetry, it is parsed
+# and the files are written on a background thread
+import base64
+import csv
+import os
+import queue
+import threading
+from datetime import datetime
+
+from supporting_functions import DECODER, logger
+
+# Columns of robot_log.csv
+LOG_COLUMNS = ['Path', 'SteerAngle', 'Throttle', 'Brake', 'Speed',
+               'X_Position', 'Y_Position', 'Pitch', 'Yaw', 'Roll']
+
+class RunRecorder():
+    def __init__(self, folder, max_queue=256):
+        self.folder = folder
+        self.image_folder = os.path.join(folder, 'IMG')
+        os.makedirs(self.image_folder, exist_ok=True)
+        self.log_path = os.path.join(folder, 'robot_log.csv')
+        # frames waiting to be written, frames that do not fit are dropped
+        # rather than slowing down the drive loop
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Queue a telemetry frame as it came in, brake is the last brake command
+    # sent since telemetry does not hold it. The frame is parsed and its
+    # camera image decoded from base64 on the writer thread
+    # returns False if the frame was dropped because the writer fell behind
+    def record(self, data, brake=0):
+        name = 'robocam_{}.jpg'.format(datetime.now().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3])
+        try:
+            self.queue.put_nowait((os.path.join(self.image_folder, name), data, brake))
+        except queue.Full:
+            self.dropped += 1
+            logger.warning('recorder queue full, dropped %d frames so far', self.dropped)
+            return False
+        self.recorded += 1
+        return True
+
+    def run(self):
+        new_log = not os.path.exists(self.log_path)
+        with open(self.log_path, 'a', newline='') as log:
+            writer = csv.writer(log, delimiter=';')
+            if new_log:
+                writer.writerow(LOG_COLUMNS)
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                path, data, brake = item
+                try:
+                    speed, x, y, yaw, pitch, roll, throttle, steer = DECODER.parse(data)[:8]
+                    with open(path, 'wb') as image_file:
+                        image_file.write(base64.b64decode(data['image']))
+                except Exception:
+                    # a bad frame or a full disk loses the frame, not the recording
+                    self.failed += 1
+                    logger.exception('recorder failed to write a frame, %d so far', self.failed)
+                    continue
+                writer.writerow((path, steer, throttle, brake, speed, x, y, pitch, yaw, roll))
+                self.written += 1
+                # keep the log complete up to the last image whenever we catch up
+                if self.queue.empty():
+                    log.flush()
+
+    # Write out the frames still queued and stop the writer thread
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
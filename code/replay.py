@@ -0,0 +1,202 @@
+# Headless replay of a recorded run (robot_log.csv and its IMG folder)
+# through the real perception and decision steps, without the simulator
+# Example: $ python replay.py ../test_dataset/robot_log.csv --fps 0
+#          $ python replay.py ../test_dataset.runlog   (a run packed with runlog.py)
+import argparse
+import contextlib
+import itertools
+import os
+import sys
+import time
+from datetime import datetime
+import cv2
+import numpy as np
+
+import perception
+from perception import perception_step
+from decision import decision_step
+from supporting_functions import convert_to_float, create_output_images
+from rover_state import RoverState
+from scheduler import PerceptionScheduler
+from runlog import read_log, resolve_image, is_runlog, RunLog
+
+# Read an image from disk as RGB, the same channel order the simulator sends
+def load_image(path):
+    return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+
+# Recording time of a frame from its file name (robocam_2017_05_02_11_16_21_421.jpg)
+def frame_time(path):
+    stamp = os.path.splitext(os.path.basename(path))[0].split('_', 1)[-1]
+    try:
+        return datetime.strptime(stamp, '%Y_%m_%d_%H_%M_%S_%f').timestamp()
+    except ValueError:
+        return None
+
+# Generator of (row, image) pairs of the frames from start to stop of a
+# recorded run, given as a robot_log.csv or a packed run log
+# the images of a robot_log.csv are decoded through cache (a FrameCache) when given
+def frames(log_path, start=0, stop=None, cache=None):
+    if is_runlog(log_path):
+        yield from RunLog(log_path).frames(start, stop)
+        return
+    for row in itertools.islice(read_log(log_path), start, stop):
+        path = resolve_image(log_path, row['Path'])
+        yield row, load_image(path) if cache is None else cache.image(path)
+
+# Number of frames of a robot_log.csv or a packed run log
+def frame_count(log_path):
+    if is_runlog(log_path):
+        return len(RunLog(log_path))
+    return sum(1 for _ in read_log(log_path))
+
+# Pass items through at fps items per second, fps of 0 runs as fast as possible
+def paced(source, fps):
+    next_time = time.perf_counter()
+    for item in source:
+        if fps > 0:
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # if we fell behind start pacing again from now instead of catching up
+            next_time = max(next_time, time.perf_counter()) + 1.0 / fps
+        yield item
+
+# Update Rover from a log row the way update_rover does from telemetry
+def apply_row(Rover, row, image, start):
+    stamp = frame_time(row['Path'])
+    if Rover.start_time is None:
+        Rover.start_time = start if stamp is None else stamp
+    Rover.total_time = (time.time() if stamp is None else stamp) - Rover.start_time
+    Rover.vel = convert_to_float(row['Speed'])
+    Rover.pos = [convert_to_float(row['X_Position']), convert_to_float(row['Y_Position'])]
+    Rover.yaw = convert_to_float(row['Yaw'])
+    Rover.pitch = convert_to_float(row['Pitch'])
+    Rover.roll = convert_to_float(row['Roll'])
+    Rover.throttle = convert_to_float(row['Throttle'])
+    Rover.steer = convert_to_float(row['SteerAngle'])
+    Rover.img = image
+    return Rover
+
+# Run every frame of source through the pipeline, yielding the Rover after each one
+# the time spent in each stage is appended to timings
+# with a scheduler perception runs at the adaptive rate of scheduler.py
+def replay_steps(Rover, source, timings, render=True, scheduler=None):
+    start = time.time()
+    while True:
+        t0 = time.perf_counter()
+        try:
+            row, image = next(source)
+        except StopIteration:
+            return
+        t1 = time.perf_counter()
+        Rover = apply_row(Rover, row, image, start)
+        if scheduler is None:
+            Rover = perception_step(Rover)
+        else:
+            Rover = scheduler.step(Rover)
+        Rover.prev_angles = Rover.nav_angles
+        t2 = time.perf_counter()
+        Rover = decision_step(Rover)
+        t3 = time.perf_counter()
+        if render:
+            create_output_images(Rover)
+        t4 = time.perf_counter()
+        timings['load'].append(t1 - t0)
+        timings['perception'].append(t2 - t1)
+        timings['decision'].append(t3 - t2)
+        timings['output'].append(t4 - t3)
+        yield Rover
+
+# Replay a recorded run and return the final Rover with the timing report
+def replay(csv_path, fps=0, render=True, quiet=True, Rover=None, scheduler=None, cache=None):
+    if Rover is None:
+        Rover = RoverState()
+    timings = {'load': [], 'perception': [], 'decision': [], 'output': []}
+    source = frames(csv_path, cache=cache)
+    count = 0
+    start = time.perf_counter()
+    # decision_step reports the mode on every frame, keep it out of the way
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull if quiet else sys.stdout):
+            # pacing happens between frames so the waiting is not counted in any stage
+            for Rover in paced(replay_steps(Rover, source, timings, render, scheduler), fps):
+                count += 1
+    elapsed = time.perf_counter() - start
+    report = {'frames': count, 'seconds': elapsed,
+              'fps': count / elapsed if elapsed > 0 else 0.0, 'stages': {}}
+    if scheduler is not None:
+        report['perception_rate'] = dict(scheduler.counts)
+    for name, values in timings.items():
+        if values:
+            ms = np.array(values) * 1000
+            report['stages'][name] = {'mean_ms': float(np.mean(ms)),
+                                      'p95_ms': float(np.percentile(ms, 95)),
+                                      'max_ms': float(np.max(ms))}
+    return Rover, report
+
+def print_report(report):
+    print('{} frames in {:.2f} s ({:.1f} FPS)'.format(report['frames'], report['seconds'], report['fps']))
+    for name, stage in report['stages'].items():
+        print('  {:<11} mean {:7.2f} ms  p95 {:7.2f} ms  max {:7.2f} ms'.format(
+            name, stage['mean_ms'], stage['p95_ms'], stage['max_ms']))
+    if 'perception_rate' in report:
+        print('  perception  ' + '  '.join('{} {}'.format(name, count)
+                                           for name, count in report['perception_rate'].items()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded run without the simulator')
+    parser.add_argument(
+        'log',
+        type=str,
+        nargs='?',
+        default='../test_dataset/robot_log.csv',
+        help='Path to the robot_log.csv of the run or to its packed run log.'
+    )
+    parser.add_argument(
+        '--fps',
+        type=float,
+        default=0,
+        help='Playback rate in frames per second, 0 replays as fast as possible.'
+    )
+    parser.add_argument(
+        '--no-render',
+        action='store_true',
+        help='Skip creating the output images.'
+    )
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help='Show what the perception and decision steps print.'
+    )
+    parser.add_argument(
+        '--adaptive',
+        action='store_true',
+        help='Skip perception on frames where the rover did not move, see scheduler.py.'
+    )
+    parser.add_argument(
+        '--roi',
+        action='store_true',
+        help='Only warp, threshold and project the part of the frame the camera sees the ground in.'
+    )
+    parser.add_argument(
+        '--downsample',
+        type=int,
+        default=1,
+        help='Run perception on every n-th row and column of the warped frame, the pixel count thresholds are scaled to match.'
+    )
+    parser.add_argument(
+        '--full-res-map',
+        action='store_true',
+        help='With --downsample keep updating the worldmap at full resolution, only the navigable pixels for decision are thinned out.'
+    )
+    args = parser.parse_args()
+
+    perception.ROI_MODE = args.roi
+    Rover = RoverState()
+    if args.downsample > 1:
+        Rover.scale_thresholds(perception.set_resolution(args.downsample, args.full_res_map))
+    scheduler = PerceptionScheduler() if args.adaptive else None
+    Rover, report = replay(args.log, fps=args.fps, render=not args.no_render, quiet=not args.verbose,
+                           Rover=Rover, scheduler=scheduler)
+    print_report(report)
+    print('Mapped: {}%  Fidelity: {}%'.format(Rover.map_stats.perc_mapped(), Rover.map_stats.fidelity()))
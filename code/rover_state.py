@@ -0,0 +1,160 @@
+import copy
+import os
+import cv2
+import numpy as np
+
+from worldmap import MapStats, OccupancyGrid
+
+# Read in ground truth map and create 3-channel green version for overplotting
+# NOTE: images are read in by default with the origin (0, 0) in the upper left
+# and y-axis increasing downward.
+# The map is looked up next to this file so the state can be built from any folder
+ground_truth = cv2.imread(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                       '..', 'calibration_images', 'map_bw.png'),
+                          cv2.IMREAD_GRAYSCALE) / 255
+# This next line creates arrays of zeros in the red and blue channels
+# and puts the map into the green channel.  This is why the underlying 
+# map output looks green in the display image
+ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.uint8)
+
+# Navigable pixel counts the decision thresholds are tuned for at full resolution
+STOP_FORWARD = 100
+GO_FORWARD = 500
+ROTATE_FORWARD = 1800
+
+# Per frame pixel sets of the rover, each kept in a preallocated float32 buffer
+# with a length counter so perception does not allocate new arrays for them
+PIXEL_FIELDS = ('nav_angles', 'nav_dists', 'prev_angles', 'rock_dists', 'rock_angles')
+# Enough room for every pixel of the camera image
+PIXEL_CAPACITY = 160 * 320
+
+# Property reading a pixel set as a view of the used part of its buffer
+# (None until one is assigned) and copying assigned arrays into the buffer
+def pixel_field(name):
+    buffer_name = name + '_buffer'
+    length_name = name + '_length'
+
+    def get(self):
+        length = getattr(self, length_name)
+        if length < 0:
+            return None
+        return getattr(self, buffer_name)[:length]
+
+    def set(self, value):
+        if value is None:
+            setattr(self, length_name, -1)
+            return
+        value = np.ravel(value)
+        buffer = getattr(self, buffer_name)
+        if len(value) > len(buffer):
+            # grow the buffer for images bigger than the camera's
+            buffer = np.zeros(len(value), dtype=np.float32)
+            setattr(self, buffer_name, buffer)
+        buffer[:len(value)] = value
+        setattr(self, length_name, len(value))
+
+    return property(get, set)
+
+# Define RoverState() class to retain rover state parameters
+# The fields are fixed by __slots__, see PIXEL_FIELDS for the pixel sets
+class RoverState():
+    __slots__ = ('start_time', 'total_time', 'img', 'pos', 'yaw', 'pitch', 'roll', 'vel',
+                 'steer', 'throttle', 'brake', 'ground_truth', 'mode', 'throttle_set',
+                 'brake_set', 'stop_forward', 'go_forward', 'rotate_forward', 'max_vel', 'vision_image',
+                 'worldmap', 'map_stats', 'samples_pos', 'samples_to_find', 'samples_located',
+                 'samples_collected', 'near_sample', 'picking_up', 'send_pickup', 'rock_found',
+                 'prev_mode', 'first_stuck', 'rock_lost', 'first_rock') \
+                + tuple(name + '_buffer' for name in PIXEL_FIELDS) \
+                + tuple(name + '_length' for name in PIXEL_FIELDS)
+
+    nav_angles = pixel_field('nav_angles')
+    nav_dists = pixel_field('nav_dists')
+    prev_angles = pixel_field('prev_angles')
+    rock_dists = pixel_field('rock_dists')
+    rock_angles = pixel_field('rock_angles')
+
+    def __init__(self):
+        for name in PIXEL_FIELDS:
+            setattr(self, name + '_buffer', np.zeros(PIXEL_CAPACITY, dtype=np.float32))
+            setattr(self, name + '_length', -1)
+        self.start_time = None # To record the start time of navigation
+        self.total_time = None # To record total duration of naviagation
+        self.img = None # Current camera image
+        self.pos = None # Current position (x, y)
+        self.yaw = None # Current yaw angle
+        self.pitch = None # Current pitch angle
+        self.roll = None # Current roll angle
+        self.vel = None # Current velocity
+        self.steer = 0 # Current steering angle
+        self.throttle = 0 # Current throttle value
+        self.brake = 0 # Current brake value
+        self.nav_angles = None # Angles of navigable terrain pixels
+        self.nav_dists = None # Distances of navigable terrain pixels
+        self.ground_truth = ground_truth_3d # Ground truth worldmap
+        self.mode = 'go-rotate'
+        self.throttle_set = 0.1 # Throttle setting when accelerating
+        self.brake_set = 10 # Brake setting when braking
+        # The stop_forward and go_forward fields below represent total count
+        # of navigable terrain pixels.  This is a very crude form of knowing
+        # when you can keep going and when you should stop.  Feel free to
+        # get creative in adding new fields or modifying these!
+        self.stop_forward = STOP_FORWARD # Threshold to initiate stopping
+        self.go_forward = GO_FORWARD # Threshold to go forward again
+        self.rotate_forward = ROTATE_FORWARD # Threshold to stop rotating towards a wall in go-rotate
+        self.max_vel = 2 # Maximum velocity (meters/second)
+        # Image output from perception step
+        # Update this image to display your intermediate analysis steps
+        # on screen in autonomous mode
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.float64) 
+        # Worldmap
+        # Update this image with the positions of navigable terrain
+        # obstacles and rock samples
+        self.worldmap = OccupancyGrid(200)
+        # Statistics of the worldmap kept up to date by perception_step
+        self.map_stats = MapStats(ground_truth_3d)
+        self.samples_pos = None # To store the actual sample positions
+        self.samples_to_find = 0 # To store the initial count of samples
+        self.samples_located = 0 # To store number of samples located on map
+        self.samples_collected = 0 # To count the number of samples collected
+        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
+        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
+        self.send_pickup = False # Set to True to trigger rock pickup
+        #STUDENT EDIT
+        #variable for mainting rover angles from previous iteration
+        self.prev_angles = None
+        self.rock_dists = None
+        self.rock_angles = None
+        self.rock_found = False
+        self.prev_mode = None
+        self.first_stuck = None
+        self.rock_lost = False
+        self.first_rock = 0
+
+    # Scale the navigable pixel count thresholds for a perception that only
+    # keeps fraction of the navigable pixels, see perception.set_resolution
+    def scale_thresholds(self, fraction):
+        self.stop_forward = STOP_FORWARD * fraction
+        self.go_forward = GO_FORWARD * fraction
+        self.rotate_forward = ROTATE_FORWARD * fraction
+
+    # Copy of the whole state that restore() can bring back later
+    # the pixel sets only copy their used part and the ground truth is shared
+    def snapshot(self):
+        state = {}
+        for name in self.__slots__:
+            if name.endswith('_buffer') or name.endswith('_length'):
+                continue
+            if name == 'ground_truth':
+                state[name] = self.ground_truth
+            else:
+                state[name] = copy.deepcopy(getattr(self, name))
+        for name in PIXEL_FIELDS:
+            value = getattr(self, name)
+            state[name] = None if value is None else value.copy()
+        return state
+
+    def restore(self, state):
+        for name, value in state.items():
+            if name != 'ground_truth' and name not in PIXEL_FIELDS:
+                value = copy.deepcopy(value)
+            setattr(self, name, value)
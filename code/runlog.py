@@ -0,0 +1,116 @@
+# Reading of recorded runs, as a robot_log.csv with an IMG folder or packed
+# into a run log folder holding two files:
+#   records.npy  one fixed size record per frame with its pose and controls
+#                and where its JPEG is in images.bin
+#   images.bin   the raw camera JPEGs of all frames one after the other
+# Both are memory mapped, so any frame is found without parsing or opening
+# anything. Pack a recorded run with
+# Example: $ python runlog.py ../test_dataset/robot_log.csv ../test_dataset.runlog
+import argparse
+import csv
+import os
+import cv2
+import numpy as np
+
+from recorder import LOG_COLUMNS
+from supporting_functions import convert_to_float
+
+RECORDS_FILE = 'records.npy'
+IMAGES_FILE = 'images.bin'
+
+# One frame of a run log, the columns of robot_log.csv (the image file name
+# in Path) and the position and size of the JPEG in images.bin
+RECORD_DTYPE = np.dtype([('Path', 'S64')]
+                        + [(name, np.float64) for name in LOG_COLUMNS[1:]]
+                        + [('offset', np.uint64), ('length', np.uint32)])
+
+# Read a semicolon separated robot_log.csv and yield one dict per frame
+def read_log(csv_path):
+    with open(csv_path) as log:
+        for row in csv.DictReader(log, delimiter=';'):
+            yield row
+
+# The image paths in the log are relative to where the run was recorded
+# if they do not exist fall back to the IMG folder next to the log
+def resolve_image(csv_path, path):
+    if os.path.exists(path):
+        return path
+    return os.path.join(os.path.dirname(os.path.abspath(csv_path)), 'IMG', os.path.basename(path))
+
+# Whether path is a packed run log rather than a robot_log.csv
+def is_runlog(path):
+    return os.path.isfile(os.path.join(path, RECORDS_FILE))
+
+# Memory mapped packed run log
+class RunLog():
+    def __init__(self, path):
+        self.path = path
+        self.records = np.load(os.path.join(path, RECORDS_FILE), mmap_mode='r')
+        images_path = os.path.join(path, IMAGES_FILE)
+        # an empty file can not be memory mapped
+        if os.path.getsize(images_path) > 0:
+            self.images = np.memmap(images_path, dtype=np.uint8, mode='r')
+        else:
+            self.images = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.records)
+
+    # the frame as a dict like the rows of read_log, with numbers instead of strings
+    def row(self, index):
+        record = self.records[index]
+        row = {name: record[name] for name in LOG_COLUMNS[1:]}
+        row['Path'] = record['Path'].decode()
+        return row
+
+    # the JPEG bytes of the frame, a view into the memory mapped images
+    def jpeg(self, index):
+        offset = int(self.records['offset'][index])
+        return self.images[offset:offset + int(self.records['length'][index])]
+
+    # the camera image of the frame as RGB
+    def image(self, index):
+        return cv2.cvtColor(cv2.imdecode(self.jpeg(index), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+    # Generator of (row, image) pairs of the frames from start to stop
+    def frames(self, start=0, stop=None):
+        for index in range(start, len(self) if stop is None else min(stop, len(self))):
+            yield self.row(index), self.image(index)
+
+# Pack the robot_log.csv of a run and its images into a run log at out_path
+# returns the number of frames packed
+def pack_run(csv_path, out_path):
+    rows = list(read_log(csv_path))
+    records = np.zeros(len(rows), dtype=RECORD_DTYPE)
+    os.makedirs(out_path, exist_ok=True)
+    offset = 0
+    with open(os.path.join(out_path, IMAGES_FILE), 'wb') as images:
+        for index, row in enumerate(rows):
+            with open(resolve_image(csv_path, row['Path']), 'rb') as image_file:
+                jpeg = image_file.read()
+            images.write(jpeg)
+            records['Path'][index] = os.path.basename(row['Path']).encode()
+            for name in LOG_COLUMNS[1:]:
+                records[name][index] = convert_to_float(row[name])
+            records['offset'][index] = offset
+            records['length'][index] = len(jpeg)
+            offset += len(jpeg)
+    np.save(os.path.join(out_path, RECORDS_FILE), records)
+    return len(rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack a recorded run into a run log')
+    parser.add_argument(
+        'log',
+        type=str,
+        help='Path to the robot_log.csv of the run.'
+    )
+    parser.add_argument(
+        'out',
+        type=str,
+        help='Folder to write the run log to.'
+    )
+    args = parser.parse_args()
+
+    count = pack_run(args.log, args.out)
+    print('Packed {} frames into {}'.format(count, args.out))
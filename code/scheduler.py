@@ -0,0 +1,63 @@
+# Adaptive rate of perception_step
+# While the rover stands still (stops, pickups, waiting in stuck) the pose and
+# the camera image hardly change between frames, so perception is skipped and
+# the nav_angles/nav_dists of the last processed frame are reused. Turns and
+# the rock mode always run at the full rate
+import cv2
+import numpy as np
+
+from perception import perception_step
+
+# What perception_step does on a frame
+FULL = 'full' # perception and worldmap update
+NO_MAP = 'no_map' # perception only, the pose is the same as the last map update
+SKIP = 'skip' # nothing, the results of the last processed frame are kept
+
+# Size of the thumbnails the camera images are compared with
+THUMB_SIZE = (32, 16)
+
+class PerceptionScheduler():
+    def __init__(self, pos_delta=0.05, yaw_delta=1.0, image_delta=3.0, turn_steer=5,
+                 max_skip=10, full_modes=('rock',)):
+        self.pos_delta = pos_delta # meters moved since the last map update that need a new one
+        self.yaw_delta = yaw_delta # degrees turned since the last map update that need a new one
+        self.image_delta = image_delta # mean absolute difference of the thumbnails that needs perception
+        self.turn_steer = turn_steer # steering angle above which the rover is turning
+        self.max_skip = max_skip # frames in a row that can be skipped
+        self.full_modes = full_modes # decision modes that always run perception at the full rate
+        self.map_pos = None # pose of the last map update
+        self.map_yaw = None
+        self.thumb = np.zeros((THUMB_SIZE[1], THUMB_SIZE[0], 3), dtype=np.uint8)
+        self.last_thumb = np.zeros_like(self.thumb) # thumbnail of the last processed frame
+        self.diff = np.zeros_like(self.thumb)
+        self.skipped = 0 # frames skipped since the last processed one
+        self.counts = {FULL: 0, NO_MAP: 0, SKIP: 0}
+
+    # what to do with the current frame of Rover, one of FULL, NO_MAP and SKIP
+    def decide(self, Rover):
+        cv2.resize(Rover.img, THUMB_SIZE, dst=self.thumb, interpolation=cv2.INTER_AREA)
+        if self.map_pos is None or Rover.mode in self.full_modes or abs(Rover.steer) >= self.turn_steer:
+            return FULL
+        moved = np.hypot(Rover.pos[0] - self.map_pos[0], Rover.pos[1] - self.map_pos[1])
+        # turned angle wrapped to [-180, 180)
+        turned = abs((Rover.yaw - self.map_yaw + 180) % 360 - 180)
+        if moved >= self.pos_delta or turned >= self.yaw_delta:
+            return FULL
+        cv2.absdiff(self.thumb, self.last_thumb, dst=self.diff)
+        if self.diff.mean() >= self.image_delta or self.skipped >= self.max_skip:
+            return NO_MAP
+        return SKIP
+
+    # Run perception_step on Rover at the rate decide asks for
+    def step(self, Rover):
+        action = self.decide(Rover)
+        self.counts[action] += 1
+        if action == SKIP:
+            self.skipped += 1
+            return Rover
+        self.skipped = 0
+        self.last_thumb[:] = self.thumb
+        if action == FULL:
+            self.map_pos = (Rover.pos[0], Rover.pos[1])
+            self.map_yaw = Rover.yaw
+        return perception_step(Rover, update_map=action == FULL)
@@ -3,19 +3,82 @@ import cv2
 from PIL import Image
 from io import BytesIO, StringIO
 import base64
+import logging
 import time
 
+import profiler
+from pipeline import LatestFrameWorker
+
 # Define a function to convert telemetry strings to float independent of decimal convention
 
 
 def convert_to_float(string_to_convert):
-    if ',' in string_to_convert:
-        float_value = np.float(string_to_convert.replace(',', '.'))
+    # numbers (from a packed run log) pass through float as they are
+    if isinstance(string_to_convert, str) and ',' in string_to_convert:
+        float_value = float(string_to_convert.replace(',', '.'))
     else:
-        float_value = np.float(string_to_convert)
+        float_value = float(string_to_convert)
     return float_value
 
 
+# Logger for the per frame telemetry status, see RateLimitFilter
+logger = logging.getLogger('rover')
+
+# Lets each distinct log message through at most once every interval seconds
+# so per frame logging does not flood the console
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, interval=1.0):
+        super().__init__()
+        self.interval = interval
+        self.last_time = {}
+
+    def filter(self, record):
+        now = time.time()
+        if now - self.last_time.get(record.msg, -np.inf) < self.interval:
+            return False
+        self.last_time[record.msg] = now
+        return True
+
+
+logger.addFilter(RateLimitFilter())
+
+# Decimal fields of a telemetry frame in the order TelemetryDecoder.parse
+# returns them, the position holds both x and y
+FLOAT_FIELDS = ('speed', 'position', 'yaw', 'pitch', 'roll', 'throttle', 'steering_angle')
+
+# Parses telemetry into plain Python numbers and decodes the camera JPEG
+# with cv2 into a reused RGB image buffer
+
+
+class TelemetryDecoder():
+    def __init__(self, shape=(160, 320, 3)):
+        self.image = np.zeros(shape, dtype=np.uint8)
+
+    # returns (speed, x, y, yaw, pitch, roll, throttle, steering_angle,
+    # near_sample, picking_up, sample_count)
+    def parse(self, data):
+        # the float fields are joined so the decimal commas are replaced and
+        # the numbers split apart in one go, "x;y" splits along with them
+        text = ';'.join([data[name] for name in FLOAT_FIELDS]).replace(',', '.')
+        return (*map(float, text.split(';')),
+                int(data['near_sample']), int(data['picking_up']), int(data['sample_count']))
+
+    # returns the RGB image and the original JPEG bytes
+    def decode_image(self, data):
+        jpeg = base64.b64decode(data["image"])
+        bgr = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if bgr.shape != self.image.shape:
+            # the camera changed size, resize the buffer to match
+            self.image = np.zeros_like(bgr)
+        cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, self.image)
+        return self.image, jpeg
+
+
+DECODER = TelemetryDecoder()
+
+
 def update_rover(Rover, data):
     # Initialize start time and sample positions
     if Rover.start_time == None:
@@ -26,116 +89,94 @@ def update_rover(Rover, data):
         samples_ypos = np.int_([convert_to_float(pos.strip())
                                 for pos in data["samples_y"].split(';')])
         Rover.samples_pos = (samples_xpos, samples_ypos)
-        Rover.samples_to_find = np.int(data["sample_count"])
+        Rover.samples_to_find = int(data["sample_count"])
     # Or just update elapsed time
     else:
         tot_time = time.time() - Rover.start_time
         if np.isfinite(tot_time):
             Rover.total_time = tot_time
-    # Print out the fields in the telemetry data dictionary
-    print(data.keys())
+    # Log the fields in the telemetry data dictionary
+    logger.debug('telemetry fields: %s', list(data.keys()))
+    with profiler.stage('parse'):
+        (speed, x, y, yaw, pitch, roll, throttle, steer,
+         near_sample, picking_up, sample_count) = DECODER.parse(data)
     # The current speed of the rover in m/s
-    Rover.vel = convert_to_float(data["speed"])
+    Rover.vel = speed
     # The current position of the rover
-    Rover.pos = [convert_to_float(pos.strip()) for pos in data["position"].split(';')]
-    # The current yaw angle of the rover
-    Rover.yaw = convert_to_float(data["yaw"])
+    Rover.pos = [x, y]
     # The current yaw angle of the rover
-    Rover.pitch = convert_to_float(data["pitch"])
-    # The current yaw angle of the rover
-    Rover.roll = convert_to_float(data["roll"])
+    Rover.yaw = yaw
+    # The current pitch angle of the rover
+    Rover.pitch = pitch
+    # The current roll angle of the rover
+    Rover.roll = roll
     # The current throttle setting
-    Rover.throttle = convert_to_float(data["throttle"])
+    Rover.throttle = throttle
     # The current steering angle
-    Rover.steer = convert_to_float(data["steering_angle"])
+    Rover.steer = steer
     # Near sample flag
-    Rover.near_sample = np.int(data["near_sample"])
+    Rover.near_sample = near_sample
     # Picking up flag
-    Rover.picking_up = np.int(data["picking_up"])
+    Rover.picking_up = picking_up
     # Update number of rocks collected
-    Rover.samples_collected = Rover.samples_to_find - np.int(data["sample_count"])
+    Rover.samples_collected = Rover.samples_to_find - sample_count
 
-    print('speed =', Rover.vel, 'position =', Rover.pos, 'throttle =',
-          Rover.throttle, 'steer_angle =', Rover.steer, 'near_sample:', Rover.near_sample,
-          'picking_up:', data["picking_up"], 'sending pickup:', Rover.send_pickup,
-          'total time:', Rover.total_time, 'samples remaining:', data["sample_count"],
-          'samples collected:', Rover.samples_collected)
+    logger.info('speed = %s position = %s throttle = %s steer_angle = %s near_sample: %s '
+                'picking_up: %s sending pickup: %s total time: %s samples remaining: %s '
+                'samples collected: %s', Rover.vel, Rover.pos, Rover.throttle, Rover.steer,
+                Rover.near_sample, Rover.picking_up, Rover.send_pickup, Rover.total_time,
+                sample_count, Rover.samples_collected)
     # Get the current image from the center camera of the rover
-    imgString = data["image"]
-    image = Image.open(BytesIO(base64.b64decode(imgString)))
-    Rover.img = np.asarray(image)
+    with profiler.stage('decode'):
+        Rover.img, jpeg = DECODER.decode_image(data)
 
-    # Return updated Rover and separate image for optional saving
-    return Rover, image
+    # Return updated Rover and the original JPEG bytes for optional saving
+    return Rover, jpeg
 
-# Define a function to create display output given worldmap results
+# Define a function to create the display image of the worldmap results
 
 
-def create_output_images(Rover):
+def render_map(Rover):
 
+    # The map statistics are kept up to date by perception_step
+    stats = Rover.map_stats
+    # Only the part of the worldmap covered by the ground truth map is shown
+    window = Rover.worldmap.window(0, Rover.ground_truth.shape[0], 0, Rover.ground_truth.shape[1])
     # Create a scaled map for plotting and clean up obs/nav pixels a bit
-    if np.max(Rover.worldmap[:, :, 2]) > 0:
-        nav_pix = Rover.worldmap[:, :, 2] > 0
-        navigable = Rover.worldmap[:, :, 2] * (255 / np.mean(Rover.worldmap[nav_pix, 2]))
-    else:
-        navigable = Rover.worldmap[:, :, 2]
-    if np.max(Rover.worldmap[:, :, 0]) > 0:
-        obs_pix = Rover.worldmap[:, :, 0] > 0
-        obstacle = Rover.worldmap[:, :, 0] * (255 / np.mean(Rover.worldmap[obs_pix, 0]))
-    else:
-        obstacle = Rover.worldmap[:, :, 0]
+    # the counters are scaled so their mean maps to 255 and saturated to uint8
+    nav_scale = 255 / stats.nav_mean() if stats.nav_cells > 0 else 0
+    obs_scale = 255 / stats.obs_mean() if stats.obs_cells > 0 else 0
+    navigable = cv2.convertScaleAbs(window[:, :, 2], alpha=nav_scale)
+    obstacle = cv2.convertScaleAbs(window[:, :, 0], alpha=obs_scale)
 
-    likely_nav = navigable >= obstacle
+    # the channels are compared before they are saturated to uint8
+    likely_nav = window[:, :, 2] * nav_scale >= window[:, :, 0] * obs_scale
     obstacle[likely_nav] = 0
-    plotmap = np.zeros_like(Rover.worldmap)
+    plotmap = np.zeros(window.shape, dtype=np.uint8)
     plotmap[:, :, 0] = obstacle
     plotmap[:, :, 2] = navigable
-    plotmap = plotmap.clip(0, 255)
     # Overlay obstacle and navigable terrain map with ground truth map
     map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
 
-    # Check whether any rock detections are present in worldmap
-    rock_world_pos = Rover.worldmap[:, :, 1].nonzero()
-    # If there are, we'll step through the known sample positions
-    # to confirm whether detections are real
-    samples_located = 0
-    if rock_world_pos[0].any():
-
-        rock_size = 2
-        for idx in range(len(Rover.samples_pos[0])):
+    # Plot the location of the known samples that rocks were detected
+    # within 3 meters of on the map
+    samples_located = stats.samples_located
+    Rover.samples_located = samples_located
+    if samples_located > 0:
+        rock_size = stats.rock_size
+        for idx in np.flatnonzero(stats.located):
             test_rock_x = Rover.samples_pos[0][idx]
             test_rock_y = Rover.samples_pos[1][idx]
-            rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 +
-                                        (test_rock_y - rock_world_pos[0])**2)
-            # If rocks were detected within 3 meters of known sample positions
-            # consider it a success and plot the location of the known
-            # sample on the map
-            if np.min(rock_sample_dists) < 3:
-                samples_located += 1
-                map_add[test_rock_y-rock_size:test_rock_y+rock_size,
-                        test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
-
-    # Calculate some statistics on the map results
-    # First get the total number of pixels in the navigable terrain map
-    tot_nav_pix = np.float(len((plotmap[:, :, 2].nonzero()[0])))
-    # Next figure out how many of those correspond to ground truth pixels
-    good_nav_pix = np.float(
-        len(((plotmap[:, :, 2] > 0) & (Rover.ground_truth[:, :, 1] > 0)).nonzero()[0]))
-    # Next find how many do not correspond to ground truth pixels
-    bad_nav_pix = np.float(
-        len(((plotmap[:, :, 2] > 0) & (Rover.ground_truth[:, :, 1] == 0)).nonzero()[0]))
-    # Grab the total number of map pixels
-    tot_map_pix = np.float(len((Rover.ground_truth[:, :, 1].nonzero()[0])))
-    # Calculate the percentage of ground truth map that has been successfully found
-    perc_mapped = round(100*good_nav_pix/tot_map_pix, 1)
-    # Calculate the number of good map pixel detections divided by total pixels
+            map_add[test_rock_y-rock_size:test_rock_y+rock_size,
+                    test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
+
+    # Percentage of the ground truth map that has been successfully found
+    perc_mapped = stats.perc_mapped()
+    # The number of good map pixel detections divided by total pixels
     # found to be navigable terrain
-    if tot_nav_pix > 0:
-        fidelity = round(100*good_nav_pix/(tot_nav_pix), 1)
-    else:
-        fidelity = 0
+    fidelity = stats.fidelity()
     # Flip the map for plotting so that the y-axis points upward in the display
-    map_add = np.flipud(map_add).astype(np.float32)
+    map_add = np.ascontiguousarray(np.flipud(map_add))
     # Add some text about map and rock sample detection results
     cv2.putText(map_add, "Time: "+str(np.round(Rover.total_time, 1))+' s', (0, 10),
                 cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
@@ -149,8 +190,20 @@ def create_output_images(Rover):
                 cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
     cv2.putText(map_add, "  Collected: "+str(Rover.samples_collected), (0, 85),
                 cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
+    return map_add
+
+# Define a function to create display output given worldmap results
+
+
+def create_output_images(Rover, encoder=None):
+    # Let the encoder refresh the images in the background if one is given
+    if encoder is not None:
+        if encoder.due():
+            encoder.submit(render_map(Rover), Rover.vision_image)
+        return encoder.strings()
+    map_add = render_map(Rover)
     # Convert map and vision image to base64 strings for sending to server
-    pil_img = Image.fromarray(map_add.astype(np.uint8))
+    pil_img = Image.fromarray(map_add)
     buff = BytesIO()
     pil_img.save(buff, format="JPEG")
     encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
@@ -161,3 +214,51 @@ def create_output_images(Rover):
     encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
 
     return encoded_string1, encoded_string2
+
+# Encodes the inset images shown in the simulator on a background thread,
+# at most refresh_rate times a second, so the control loop only picks up
+# the last encoded strings. An image that did not change since it was last
+# encoded reuses its old string. The images can be downscaled by scale
+# and the JPEG quality lowered to make encoding and sending cheaper.
+
+
+class InsetEncoder():
+    def __init__(self, refresh_rate=4.0, quality=75, scale=1.0):
+        self.interval = 1.0 / refresh_rate if refresh_rate > 0 else 0.0
+        self.quality = quality
+        self.scale = scale
+        self.last_submit = None
+        self.last_images = [None, None]
+        self.encoded = ['', '']
+        self.reused = 0
+        # an image that fails to encode leaves the insets empty until the next refresh
+        self.worker = LatestFrameWorker(self.encode)
+
+    # whether enough time passed since the last refresh
+    def due(self):
+        return self.last_submit is None or time.time() - self.last_submit >= self.interval
+
+    def submit(self, map_img, vision_image):
+        self.last_submit = time.time()
+        # copies, the caller keeps drawing into its images
+        self.worker.submit((map_img.copy(), vision_image.astype(np.uint8)))
+
+    # the last encoded (map, vision) strings
+    def strings(self):
+        result, _ = self.worker.latest()
+        return ('', '') if result is None else result
+
+    def encode(self, images):
+        for idx, img in enumerate(images):
+            if self.last_images[idx] is not None and np.array_equal(img, self.last_images[idx]):
+                self.reused += 1
+                continue
+            small = img
+            if self.scale != 1.0:
+                small = cv2.resize(img, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+            ok, buff = cv2.imencode('.jpg', cv2.cvtColor(small, cv2.COLOR_RGB2BGR),
+                                    [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            self.encoded[idx] = base64.b64encode(buff.tobytes()).decode("utf-8")
+            # only remembered once encoded, an image that failed is encoded again
+            self.last_images[idx] = img
+        return tuple(self.encoded)
@@ -0,0 +1,262 @@
+# Sweep of the perception thresholds over a recorded run
+# Every configuration maps the whole run into its own worldmap and is scored
+# against the ground truth map: the mapped and fidelity percentages of the
+# navigable terrain times the share of the obstacle cells that are not
+# navigable in the ground truth. With the positions of the rock samples of the
+# run the configurations that locate more of them rank first, and among equal
+# scores the one with fewer rock cells away from any sample.
+# The configurations are spread over a pool of worker processes, each of which
+# warps every frame only once and keeps the warped ground pixels in a FrameCache
+# Example: $ python sweep.py --nav 130,170,130 --nav 137,175,134 --max-dist 60 --max-dist 80
+#          $ python sweep.py --random 40 --spread 15 --out sweep.csv
+#          $ python sweep.py --rock 100,100,50 --rock 110,110,40 --samples 100,85 --samples 60,100
+import argparse
+import csv
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import perception
+from perception import GroundROI, PerceptionContext, TerrainClassifier, frame_thresh
+from framecache import FrameCache
+from runlog import read_log, resolve_image, is_runlog, RunLog
+from replay import load_image
+from rover_state import ground_truth_3d
+from supporting_functions import convert_to_float
+from worldmap import MapStats, OccupancyGrid
+
+# Parameters of a configuration
+# nav_thresh  navigable terrain is above it (NAV_THRESH)
+# rock_thresh rocks are above it in red and green and below it in blue
+# obs_thresh  obstacles are below it, the navigable threshold when None
+# max_dist    obstacles further than it in rover pixels are dropped (ignoreFar)
+DEFAULT_CONFIG = {'nav_thresh': perception.NAV_THRESH, 'rock_thresh': (100, 100, 50),
+                  'obs_thresh': None, 'max_dist': 80}
+# Columns of the results table
+RESULT_COLUMNS = ['rank', 'located', 'score', 'mapped', 'fidelity', 'obs_fidelity', 'rock_fidelity',
+                  'nav_cells', 'bad_nav', 'obs_cells', 'rock_cells',
+                  'nav_thresh', 'rock_thresh', 'obs_thresh', 'max_dist']
+
+# Per worker process state, set up by init_worker
+FRAMES = None # (row, cache key, image loader) of every frame of the run
+CACHE = None
+SAMPLES_POS = None # (x, y) arrays of the rock sample positions, None when unknown
+ROIS = {} # max_dist -> GroundROI
+
+# (row, cache key, image loader) of every frame of a robot_log.csv or a packed run log
+def run_frames(log_path):
+    if is_runlog(log_path):
+        run = RunLog(log_path)
+        return [(run.row(index), (log_path, index), lambda index=index: run.image(index))
+                for index in range(len(run))]
+    frames = []
+    for row in read_log(log_path):
+        path = resolve_image(log_path, row['Path'])
+        frames.append((row, path, lambda path=path: load_image(path)))
+    return frames
+
+def init_worker(log_path, cache_bytes, samples_pos=None):
+    global FRAMES, CACHE, SAMPLES_POS
+    FRAMES = run_frames(log_path)
+    CACHE = FrameCache(cache_bytes)
+    SAMPLES_POS = samples_pos
+
+# the ground region culling obstacles at max_dist, built once per worker
+def ground_roi(max_dist):
+    if max_dist not in ROIS:
+        ROIS[max_dist] = GroundROI(perception.WARP, PerceptionContext(), max_dist=max_dist)
+    return ROIS[max_dist]
+
+# Map the run with one configuration and score it against the ground truth
+def evaluate(config):
+    roi = ground_roi(config['max_dist'])
+    classifier = TerrainClassifier(config['rock_thresh'], roi.pixels.shape, config['obs_thresh'])
+    worldmap = OccupancyGrid(200)
+    stats = MapStats(ground_truth_3d)
+    for row, key, load in FRAMES:
+        # the warped ground pixels do not depend on the configuration
+        pixels = CACHE.get((key, 'ground'), lambda: roi.warp(load()).copy())
+        thresh, _ = frame_thresh(convert_to_float(row['Pitch']), config['nav_thresh'])
+        roi.threshold(pixels, thresh, classifier, frames=False)
+        pos = (convert_to_float(row['X_Position']), convert_to_float(row['Y_Position']))
+        roi.map_frame(worldmap, pos, convert_to_float(row['Yaw']), convert_to_float(row['Roll']), stats,
+                      SAMPLES_POS)
+    mapped, fidelity = stats.perc_mapped(), stats.fidelity()
+    obs_fidelity = obstacle_fidelity(worldmap, stats)
+    rock_cells, rock_fidelity = rock_stats(worldmap, SAMPLES_POS)
+    result = dict(config)
+    result.update({'score': round(mapped * fidelity * obs_fidelity / 10000, 2), 'mapped': mapped,
+                   'fidelity': fidelity, 'obs_fidelity': obs_fidelity, 'rock_fidelity': rock_fidelity,
+                   'located': stats.samples_located, 'nav_cells': stats.nav_cells, 'bad_nav': stats.bad_nav,
+                   'obs_cells': stats.obs_cells, 'rock_cells': rock_cells})
+    return result
+
+# percentage of the obstacle cells that are not navigable in the ground truth
+def obstacle_fidelity(worldmap, stats):
+    obs_y, obs_x = worldmap.data[:, :, 0].nonzero()
+    if len(obs_y) == 0:
+        return 0
+    return round(100 * (1 - np.count_nonzero(stats.in_truth(obs_y, obs_x)) / len(obs_y)), 1)
+
+# number of rock cells and the percentage of them within 3 meters of a sample
+# the percentage is None without the sample positions
+def rock_stats(worldmap, samples_pos):
+    rock_y, rock_x = worldmap.data[:, :, 1].nonzero()
+    if samples_pos is None or len(rock_y) == 0:
+        return len(rock_y), None
+    dists = np.hypot(samples_pos[0][:, np.newaxis] - rock_x, samples_pos[1][:, np.newaxis] - rock_y)
+    return len(rock_y), round(100 * np.count_nonzero(dists.min(axis=0) < 3) / len(rock_y), 1)
+
+# Every combination of the given values of each parameter
+def grid_configs(values):
+    names = list(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*values.values())]
+
+# count configurations with every threshold drawn within spread of the defaults
+# the rock threshold is only drawn with rocks, it can not be scored without the sample positions
+def random_configs(count, spread, max_dists, rocks=True, seed=0):
+    rng = np.random.default_rng(seed)
+    def near(thresh):
+        return tuple(int(value) for value in np.clip(np.add(thresh, rng.integers(-spread, spread + 1, 3)), 0, 255))
+    return [{'nav_thresh': near(DEFAULT_CONFIG['nav_thresh']),
+             'rock_thresh': near(DEFAULT_CONFIG['rock_thresh']) if rocks else DEFAULT_CONFIG['rock_thresh'],
+             'obs_thresh': near(DEFAULT_CONFIG['nav_thresh']),
+             'max_dist': max_dists[rng.integers(len(max_dists))]} for _ in range(count)]
+
+# Evaluate every configuration on workers processes
+# samples_pos, the (x, y) arrays of the rock sample positions, scores the rock thresholds
+# returns the results ranked by samples located and score, the best first
+def sweep(log_path, configs, workers=None, cache_bytes=256 * 1024 * 1024, samples_pos=None):
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        init_worker(log_path, cache_bytes, samples_pos)
+        results = [evaluate(config) for config in configs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(log_path, cache_bytes, samples_pos)) as pool:
+            results = list(pool.map(evaluate, configs))
+    results.sort(key=lambda result: (result['located'], result['score'], result['rock_fidelity'] or 0,
+                                     result['fidelity']), reverse=True)
+    for rank, result in enumerate(results, 1):
+        result['rank'] = rank
+    return results
+
+def write_results(results, path):
+    with open(path, 'w', newline='') as out:
+        writer = csv.DictWriter(out, RESULT_COLUMNS, delimiter=';')
+        writer.writeheader()
+        for result in results:
+            writer.writerow({name: result[name] for name in RESULT_COLUMNS})
+
+# parse "137,175,134" into a threshold tuple
+def thresh_arg(text):
+    return tuple(int(value) for value in text.split(','))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep the perception thresholds over a recorded run')
+    parser.add_argument(
+        'log',
+        type=str,
+        nargs='?',
+        default='../test_dataset/robot_log.csv',
+        help='Path to the robot_log.csv of the run or to its packed run log.'
+    )
+    parser.add_argument(
+        '--nav',
+        type=thresh_arg,
+        action='append',
+        help='Navigable threshold to try as R,G,B, can be given several times.'
+    )
+    parser.add_argument(
+        '--rock',
+        type=thresh_arg,
+        action='append',
+        help='Rock threshold to try as R,G,B, can be given several times.'
+    )
+    parser.add_argument(
+        '--obs',
+        type=thresh_arg,
+        action='append',
+        help='Obstacle threshold to try as R,G,B, can be given several times (default: the navigable one).'
+    )
+    parser.add_argument(
+        '--samples',
+        type=thresh_arg,
+        action='append',
+        help='Position of a rock sample of the run as X,Y in map cells, can be given several times. '
+             'Without them the rock thresholds can not be scored.'
+    )
+    parser.add_argument(
+        '--max-dist',
+        type=float,
+        action='append',
+        help='Obstacle cutoff in rover pixels to try, can be given several times.'
+    )
+    parser.add_argument(
+        '--random',
+        type=int,
+        default=0,
+        help='Try this many random configurations around the defaults instead of the grid.'
+    )
+    parser.add_argument(
+        '--spread',
+        type=int,
+        default=10,
+        help='How far the random thresholds go from the defaults.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Number of worker processes, defaults to the number of cores.'
+    )
+    parser.add_argument(
+        '--cache-mb',
+        type=float,
+        default=256,
+        help='Size of the cache of warped frames of every worker in megabytes.'
+    )
+    parser.add_argument(
+        '--out',
+        type=str,
+        default='sweep_results.csv',
+        help='Path to write the ranked results table to.'
+    )
+    parser.add_argument(
+        '--top',
+        type=int,
+        default=10,
+        help='Number of the best configurations to print.'
+    )
+    args = parser.parse_args()
+
+    samples_pos = None
+    if args.samples:
+        samples_pos = (np.int_([pos[0] for pos in args.samples]), np.int_([pos[1] for pos in args.samples]))
+    elif args.rock:
+        parser.error('--rock needs the --samples positions to score the rock thresholds')
+    max_dists = args.max_dist or [DEFAULT_CONFIG['max_dist']]
+    if args.random > 0:
+        configs = random_configs(args.random, args.spread, max_dists, rocks=samples_pos is not None)
+    else:
+        # without any values given sweep the navigable threshold around the default
+        nav = args.nav or [tuple(value + offset for value in DEFAULT_CONFIG['nav_thresh'])
+                           for offset in (-10, 0, 10)]
+        configs = grid_configs({'nav_thresh': nav,
+                                'rock_thresh': args.rock or [DEFAULT_CONFIG['rock_thresh']],
+                                'obs_thresh': args.obs or [DEFAULT_CONFIG['obs_thresh']],
+                                'max_dist': max_dists})
+    start = time.perf_counter()
+    results = sweep(args.log, configs, args.workers, int(args.cache_mb * 1024 * 1024), samples_pos)
+    print('{} configurations in {:.1f} s'.format(len(results), time.perf_counter() - start))
+    write_results(results, args.out)
+    print('{:>4} {:>7} {:>6} {:>7} {:>8} {:>8} {:>6}  {:<16} {:<16} {:<16} {}'.format(
+        'rank', 'located', 'score', 'mapped', 'fidelity', 'obstacle', 'rock', 'nav', 'rock', 'obstacle', 'max dist'))
+    for result in results[:args.top]:
+        print('{:>4} {:>7} {:>6} {:>7} {:>8} {:>8} {:>6}  {:<16} {:<16} {:<16} {}'.format(
+            result['rank'], result['located'], result['score'], result['mapped'], result['fidelity'],
+            result['obs_fidelity'], str(result['rock_fidelity']), str(result['nav_thresh']),
+            str(result['rock_thresh']), str(result['obs_thresh']), result['max_dist']))
+    print('Results written to {}'.format(args.out))
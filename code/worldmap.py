@@ -0,0 +1,261 @@
+import os
+import numpy as np
+
+# Halve the counters of a channel rounding up, so mapped cells stay mapped
+def halve(counters):
+    np.subtract(counters, counters >> 1, out=counters)
+
+# Whether writing added to counters at old would go past max_value with room
+# left to make by halving, a single write larger than max_value still saturates
+def must_halve(old, added, max_value):
+    if len(old) == 0:
+        return False
+    return bool(np.any(old + added > max_value)) and int(old.max()) > 1
+
+# A compact occupancy grid for the worldmap
+# Each of the obstacle, rock and navigable channels is a uint16 counter and
+# every write is accumulated the way np.add.at would, so pixels of a frame
+# that land on the same cell all count. A write that would go past max_value
+# halves the whole channel first instead of saturating the cell. The display
+# scales every channel by its mean so halving it leaves the map as it was,
+# while saturated cells would all look the same. halvings counts them per channel
+class OccupancyGrid():
+    def __init__(self, world_size, dtype=np.uint16):
+        self.world_size = world_size
+        self.data = np.zeros((world_size, world_size, 3), dtype=dtype)
+        self.max_value = np.iinfo(dtype).max
+        self.halvings = [0, 0, 0]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    # numpy style indexing returns views of the underlying counters
+    def __getitem__(self, key):
+        return self.data[key]
+
+    # view of the rows y0:y1 and columns x0:x1 of the map for the display path
+    # the parts of the window outside the map are 0, in a copy, like the tiled map does
+    def window(self, y0, y1, x0, x1):
+        size = self.world_size
+        if 0 <= y0 and y1 <= size and 0 <= x0 and x1 <= size:
+            return self.data[y0:y1, x0:x1]
+        out = np.zeros((y1 - y0, x1 - x0, 3), dtype=self.data.dtype)
+        r0, r1 = max(y0, 0), min(y1, size)
+        c0, c1 = max(x0, 0), min(x1, size)
+        if r0 < r1 and c0 < c1:
+            out[r0 - y0:r1 - y0, c0 - x0:c1 - x0] = self.data[r0:r1, c0:c1]
+        return out
+
+    # Add amount for every (y, x) pair to the given channel
+    # returns the unique cells touched with their values before and after the write
+    def add(self, channel, y, x, amount):
+        cells, counts = np.unique(y * self.data.shape[1] + x, return_counts=True)
+        cell_y, cell_x = np.divmod(cells, self.data.shape[1])
+        added = counts * np.int64(amount)
+        old = self.data[cell_y, cell_x, channel]
+        while must_halve(old, added, self.max_value):
+            halve(self.data[:, :, channel])
+            self.halvings[channel] += 1
+            old = self.data[cell_y, cell_x, channel]
+        new = np.minimum(old + added, self.max_value).astype(self.data.dtype)
+        self.data[cell_y, cell_x, channel] = new
+        return cell_y, cell_x, old, new
+
+    # sum of the counters of a channel
+    def channel_sum(self, channel):
+        return float(np.sum(self.data[:, :, channel], dtype=np.int64))
+
+    # Add the counters of another grid (or array) of the same size
+    # channels whose sums go past max_value are halved until they fit
+    def merge(self, other):
+        other = other.data if isinstance(other, OccupancyGrid) else other
+        total = self.data.astype(np.int64) + other
+        for channel in range(3):
+            while total[:, :, channel].max() > self.max_value:
+                halve(total[:, :, channel])
+                self.halvings[channel] += 1
+        self.data[:] = total
+
+# A sparse worldmap made of square tiles that are only allocated once the rover
+# maps something in them, so memory grows with the area explored instead of
+# a fixed bounding box. Coordinates are not clipped and may be negative.
+# With a spill_dir every tile is a memory mapped .npy file in that directory
+# and the operating system keeps only the recently used tiles in RAM
+class TiledOccupancyGrid():
+    def __init__(self, tile_size=64, dtype=np.uint16, spill_dir=None):
+        self.world_size = None # the map is unbounded
+        self.tile_size = tile_size
+        self.dtype = np.dtype(dtype)
+        self.max_value = np.iinfo(dtype).max
+        self.halvings = [0, 0, 0]
+        self.spill_dir = spill_dir
+        if spill_dir is not None and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+        self.tiles = {} # (tile row, tile column) -> (tile_size, tile_size, 3) counters
+
+    def tile(self, ty, tx):
+        if (ty, tx) not in self.tiles:
+            shape = (self.tile_size, self.tile_size, 3)
+            if self.spill_dir is None:
+                self.tiles[(ty, tx)] = np.zeros(shape, dtype=self.dtype)
+            else:
+                path = os.path.join(self.spill_dir, 'tile_{}_{}.npy'.format(ty, tx))
+                self.tiles[(ty, tx)] = np.lib.format.open_memmap(path, mode='w+',
+                                                                 dtype=self.dtype, shape=shape)
+        return self.tiles[(ty, tx)]
+
+    # bytes held by the allocated tiles
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    # Same as OccupancyGrid.add, the touched tiles are allocated as needed
+    def add(self, channel, y, x, amount):
+        y = np.asarray(y, dtype=np.int64)
+        x = np.asarray(x, dtype=np.int64)
+        if len(y) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0, self.dtype), np.zeros(0, self.dtype)
+        y_min, x_min = y.min(), x.min()
+        width = x.max() - x_min + 1
+        cells, counts = np.unique((y - y_min) * width + (x - x_min), return_counts=True)
+        cell_y, cell_x = np.divmod(cells, width)
+        cell_y += y_min
+        cell_x += x_min
+        added = counts * np.int64(amount)
+        tile_y, in_y = np.divmod(cell_y, self.tile_size)
+        tile_x, in_x = np.divmod(cell_x, self.tile_size)
+        tile_ids = np.unique(np.stack((tile_y, tile_x), axis=1), axis=0)
+        selections = [(self.tile(int(ty), int(tx)), (tile_y == ty) & (tile_x == tx)) for ty, tx in tile_ids]
+        old = self.gather(selections, in_y, in_x, channel)
+        while must_halve(old, added, self.max_value):
+            for tile in self.tiles.values():
+                halve(tile[:, :, channel])
+            self.halvings[channel] += 1
+            old = self.gather(selections, in_y, in_x, channel)
+        new = np.minimum(old + added, self.max_value).astype(self.dtype)
+        for tile, sel in selections:
+            tile[in_y[sel], in_x[sel], channel] = new[sel]
+        return cell_y, cell_x, old, new
+
+    # counters of the cells in_y, in_x of a channel, spread over the selected tiles
+    def gather(self, selections, in_y, in_x, channel):
+        old = np.zeros(len(in_y), dtype=self.dtype)
+        for tile, sel in selections:
+            old[sel] = tile[in_y[sel], in_x[sel], channel]
+        return old
+
+    def channel_sum(self, channel):
+        return float(sum(np.sum(tile[:, :, channel], dtype=np.int64) for tile in self.tiles.values()))
+
+    # dense copy of the rows y0:y1 and columns x0:x1 of the map, unmapped areas are 0
+    def window(self, y0, y1, x0, x1):
+        out = np.zeros((y1 - y0, x1 - x0, 3), dtype=self.dtype)
+        size = self.tile_size
+        for (ty, tx), tile in self.tiles.items():
+            top, left = ty * size, tx * size
+            r0, r1 = max(y0, top), min(y1, top + size)
+            c0, c1 = max(x0, left), min(x1, left + size)
+            if r0 < r1 and c0 < c1:
+                out[r0 - y0:r1 - y0, c0 - x0:c1 - x0] = tile[r0 - top:r1 - top, c0 - left:c1 - left]
+        return out
+
+# Keeps the map statistics shown by create_output_images up to date
+# as perception_step writes into the OccupancyGrid, so reporting them only
+# costs the pixels touched in the current frame instead of a scan of the map
+class MapStats():
+    def __init__(self, ground_truth):
+        # ground truth navigable terrain, the green channel of the ground truth map
+        self.truth = ground_truth[:, :, 1] > 0
+        self.map_cells = int(np.count_nonzero(self.truth)) # total number of map pixels
+        self.nav_cells = 0 # number of pixels mapped as navigable
+        self.good_nav = 0 # number of those that are navigable in the ground truth
+        self.nav_sum = 0.0 # sum of the navigable channel
+        self.obs_cells = 0 # number of pixels mapped as obstacles
+        self.obs_sum = 0.0 # sum of the obstacle channel
+        self.located = None # which of the samples have been located on the map
+        self.rock_size = 2 # half size of the square drawn around a located sample
+
+    # Recompute every statistic from the full contents of an OccupancyGrid
+    # for maps that were not written through this object, like merged ones
+    def scan(self, grid, samples_pos=None):
+        nav = grid.data[:, :, 2]
+        obs = grid.data[:, :, 0]
+        nav_y, nav_x = nav.nonzero()
+        self.nav_cells = len(nav_y)
+        self.nav_sum = float(np.sum(nav, dtype=np.int64))
+        self.good_nav = int(np.count_nonzero(self.in_truth(nav_y, nav_x)))
+        self.obs_cells = int(np.count_nonzero(obs))
+        self.obs_sum = float(np.sum(obs, dtype=np.int64))
+        self.located = None
+        rock_y, rock_x = grid.data[:, :, 1].nonzero()
+        self.locate(rock_y, rock_x, samples_pos)
+
+    # whether the cells are navigable in the ground truth, cells outside it are not
+    def in_truth(self, cell_y, cell_x):
+        inside = (cell_y >= 0) & (cell_y < self.truth.shape[0]) \
+               & (cell_x >= 0) & (cell_x < self.truth.shape[1])
+        return self.truth[cell_y[inside], cell_x[inside]]
+
+    # the sum of a channel after a write, summed again when the write halved the channel
+    def updated_sum(self, total, grid, channel, halvings, old, new):
+        if grid.halvings[channel] != halvings:
+            return grid.channel_sum(channel)
+        return total + float(np.sum(new, dtype=np.int64) - np.sum(old, dtype=np.int64))
+
+    def add_navigable(self, grid, y, x, amount):
+        halvings = grid.halvings[2]
+        cell_y, cell_x, old, new = grid.add(2, y, x, amount)
+        added = old == 0
+        self.nav_sum = self.updated_sum(self.nav_sum, grid, 2, halvings, old, new)
+        self.nav_cells += int(np.count_nonzero(added))
+        self.good_nav += int(np.count_nonzero(self.in_truth(cell_y[added], cell_x[added])))
+
+    def add_obstacles(self, grid, y, x, amount):
+        halvings = grid.halvings[0]
+        cell_y, cell_x, old, new = grid.add(0, y, x, amount)
+        self.obs_sum = self.updated_sum(self.obs_sum, grid, 0, halvings, old, new)
+        self.obs_cells += int(np.count_nonzero(old == 0))
+
+    # rock detections within 3 meters of a known sample position mark it as located
+    def add_rocks(self, grid, y, x, amount, samples_pos):
+        cell_y, cell_x, old, new = grid.add(1, y, x, amount)
+        self.locate(cell_y, cell_x, samples_pos)
+
+    def locate(self, cell_y, cell_x, samples_pos):
+        if samples_pos is None or len(cell_y) == 0:
+            return
+        if self.located is None:
+            self.located = np.zeros(len(samples_pos[0]), dtype=bool)
+        for idx in np.flatnonzero(~self.located):
+            rock_sample_dists = np.sqrt((samples_pos[0][idx] - cell_x)**2 +
+                                        (samples_pos[1][idx] - cell_y)**2)
+            if np.min(rock_sample_dists) < 3:
+                self.located[idx] = True
+
+    @property
+    def samples_located(self):
+        if self.located is None:
+            return 0
+        return int(np.count_nonzero(self.located))
+
+    @property
+    def bad_nav(self):
+        return self.nav_cells - self.good_nav
+
+    # mean value of the mapped navigable and obstacle pixels
+    def nav_mean(self):
+        return self.nav_sum / self.nav_cells if self.nav_cells > 0 else 0.0
+
+    def obs_mean(self):
+        return self.obs_sum / self.obs_cells if self.obs_cells > 0 else 0.0
+
+    # percentage of the ground truth map that has been successfully found
+    def perc_mapped(self):
+        return round(100*self.good_nav/self.map_cells, 1)
+
+    # good map pixel detections divided by total pixels found to be navigable terrain
+    def fidelity(self):
+        if self.nav_cells > 0:
+            return round(100*self.good_nav/self.nav_cells, 1)
+        return 0